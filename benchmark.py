@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of parsing and slot selection, over inputs built by
+generate_fixtures.
+
+    ./benchmark.py run -o baseline.json
+    ./benchmark.py compare baseline.json
+
+compare runs the benchmarks again, or reads them from a second file, and
+exits with an error when one of them is slower than the baseline by more
+than the threshold.
+"""
+import argparse
+import datetime
+import json
+import platform
+import re
+import sys
+import timeit
+
+from requests.models import Response
+from woob.browser.browsers import Browser
+
+from doctoshotgun import AvailabilitiesPage, CenterBookingPage, CentersPage, Doctolib, DoctolibDE
+from generate_fixtures import availabilities_windows, booking_profile, centers_pages
+
+DEFAULT_SCALES = (10, 1000, 100000)
+
+
+def make_page(klass, content, content_type='application/json'):
+    response = Response()
+    response._content = content.encode('utf-8')
+    response.encoding = 'utf-8'
+    response.url = 'https://127.0.0.1/'
+    response.headers['Content-Type'] = content_type
+    return klass(browser=Browser(), response=response)
+
+
+def centers_html(scale):
+    return centers_pages(pages=2, centers_per_page=scale)[0]
+
+
+def booking_doc(scale):
+    doc = booking_profile(motives=scale, agendas=scale, places=max(1, scale // 10))
+    # the searched motive is the last one
+    motives = doc['data']['visit_motives']
+    for motive in motives:
+        motive['name'] = motive['name'].replace('Janssen', 'AstraZeneca')
+    motives[-1].update(name='Erstimpfung Covid-19 (Janssen)', allow_new_patients=True)
+    return doc
+
+
+def availabilities_doc(scale):
+    # one window holding all slots, 50 by day
+    slots_per_day = min(scale, 50)
+    doc, = availabilities_windows(windows=1, limit=-(-scale // slots_per_day), density=1.0,
+                                  slots_per_day=slots_per_day, days_range=42)
+    return doc
+
+
+def bench_iter_centers_ids(scale):
+    page = make_page(CentersPage, centers_html(scale), 'text/html')
+    return lambda: list(page.iter_centers_ids())
+
+
+def bench_get_next_page(scale):
+    page = make_page(CentersPage, centers_html(scale), 'text/html')
+    return page.get_next_page
+
+
+def bench_find_motives(scale):
+    page = make_page(CenterBookingPage, json.dumps(booking_doc(scale)))
+    vaccines = [DoctolibDE.vaccine_motives[key] for key in (DoctolibDE.KEY_PFIZER, DoctolibDE.KEY_MODERNA,
+                                                           DoctolibDE.KEY_ASTRAZENECA, DoctolibDE.KEY_JANSSEN)]
+    single_shot_vaccines = [DoctolibDE.vaccine_motives[DoctolibDE.KEY_JANSSEN]]
+
+    def run():
+        # motives are memoized by the first call on a page
+        page.motives_index = {}
+        return page.find_motives(DoctolibDE.motive_matcher, vaccines, single_shot_vaccines, verbose=False)
+    return run
+
+
+def bench_get_agenda_ids(scale):
+    page = make_page(CenterBookingPage, json.dumps(booking_doc(scale)))
+    agenda = [agenda for agenda in page.doc['data']['agendas'] if not agenda['booking_disabled']][-1]
+    motive_id = agenda['visit_motive_ids'][0]
+    practice_id = agenda['practice_id']
+
+    def run():
+        # the index is built by the first call on a page
+        page.agendas_index = None
+        return page.get_agenda_ids(motive_id, practice_id)
+    return run
+
+
+def bench_find_best_slot(scale):
+    page = make_page(AvailabilitiesPage, json.dumps(availabilities_doc(scale)))
+    end_date = datetime.date(2022, 12, 31)
+
+    def run():
+        # slots are parsed by the first call on a page
+        page.days = None
+        return page.find_best_slot(end_date=end_date)
+    return run
+
+
+def bench_normalize(scale):
+    cities = ['Saint-Étienne-du-Rouvray %s' % i for i in range(scale)]
+    return lambda: [Doctolib.normalize(city) for city in cities]
+
+
+BENCHMARKS = (
+    ('iter_centers_ids', bench_iter_centers_ids),
+    ('get_next_page', bench_get_next_page),
+    ('find_motives', bench_find_motives),
+    ('get_agenda_ids', bench_get_agenda_ids),
+    ('find_best_slot', bench_find_best_slot),
+    ('normalize', bench_normalize),
+)
+
+
+def run_benchmarks(scales=DEFAULT_SCALES, repeat=5, pattern=None, verbose=True):
+    """
+    Return the best time in seconds of each benchmark, by 'name[scale]'.
+    """
+    results = {}
+    for name, setup in BENCHMARKS:
+        if pattern and not re.search(pattern, name):
+            continue
+        for scale in scales:
+            key = '%s[%s]' % (name, scale)
+            timer = timeit.Timer(setup(scale))
+            number, _ = timer.autorange()
+            results[key] = min(timer.repeat(repeat=repeat, number=number)) / number
+            if verbose:
+                print('%-32s %12.6f ms' % (key, results[key] * 1000), flush=True)
+    return results
+
+
+def compare_results(baseline, current, threshold=0.2):
+    """
+    Return (key, baseline, current, ratio, regressed) of benchmarks found in both results.
+    """
+    comparison = []
+    for key, base_time in baseline.items():
+        if key not in current:
+            continue
+        ratio = current[key] / base_time if base_time else float('inf')
+        comparison.append((key, base_time, current[key], ratio, ratio > 1 + threshold))
+    return comparison
+
+
+def load_results(filename):
+    with open(filename) as fp:
+        return json.load(fp)
+
+
+def save_results(filename, results, scales, repeat):
+    with open(filename, 'w') as fp:
+        json.dump({'python': platform.python_version(),
+                   'machine': platform.machine(),
+                   'scales': list(scales),
+                   'repeat': repeat,
+                   'results': results,
+                   }, fp, indent=2, sort_keys=True)
+
+
+def main(cli_args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of doctoshotgun hot paths')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run benchmarks')
+    run_parser.add_argument('--output', '-o', help='write results to this JSON file')
+    run_parser.add_argument('--scales', default=','.join(str(scale) for scale in DEFAULT_SCALES),
+                            help='comma separated numbers of centers, slots and motives (default = %(default)s)')
+    run_parser.add_argument('--repeat', type=int, default=5, help='number of measures, the best one is kept (default = 5)')
+    run_parser.add_argument('--filter', help='only run benchmarks matching this regex')
+
+    compare_parser = subparsers.add_parser('compare', help='compare results with a baseline')
+    compare_parser.add_argument('baseline', help='JSON file of baseline results')
+    compare_parser.add_argument('current', nargs='?', help='JSON file of current results (default = run benchmarks again)')
+    compare_parser.add_argument('--threshold', type=float, default=0.2,
+                                help='slowdown ratio over which a benchmark is a regression (default = 0.2)')
+    compare_parser.add_argument('--filter', help='only compare benchmarks matching this regex')
+
+    args = parser.parse_args(cli_args)
+
+    if args.command == 'run':
+        scales = [int(scale) for scale in args.scales.split(',')]
+        results = run_benchmarks(scales, args.repeat, args.filter)
+        if args.output:
+            save_results(args.output, results, scales, args.repeat)
+        return 0
+
+    baseline = load_results(args.baseline)
+    if args.current:
+        current = load_results(args.current)['results']
+    else:
+        current = run_benchmarks(baseline['scales'], baseline['repeat'], args.filter, verbose=False)
+
+    regressions = 0
+    for key, base_time, current_time, ratio, regressed in compare_results(baseline['results'], current, args.threshold):
+        if args.filter and not re.search(args.filter, key):
+            continue
+        regressions += regressed
+        print('%-32s %12.6f ms %12.6f ms %7.2fx%s' % (key, base_time * 1000, current_time * 1000, ratio,
+                                                     '  REGRESSION' if regressed else ''))
+
+    if regressions:
+        print('%s benchmark(s) slower than baseline by more than %d%%' % (regressions, args.threshold * 100))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,7 +4,7 @@ import os
 import re
 import logging
 import tempfile
-from time import sleep
+from time import sleep, time
 import json
 from urllib.parse import urlparse
 import datetime
@@ -12,6 +12,15 @@ import argparse
 from pathlib import Path
 import getpass
 import unicodedata
+import threading
+import functools
+import itertools
+import heapq
+import queue
+import subprocess
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 
 from dateutil.parser import parse as parse_date
 from dateutil.relativedelta import relativedelta
@@ -19,6 +28,7 @@ from dateutil.relativedelta import relativedelta
 import calendar
 import cloudscraper
 import colorama
+import requests
 from requests.adapters import ReadTimeout, ConnectionError
 from termcolor import colored
 from urllib import parse
@@ -65,17 +75,62 @@ def log_ts(text=None, *args, **kwargs):
         log(text, *args, **kwargs)
 
 
+def parse_iso_datetime(string):
+    try:
+        return datetime.datetime.fromisoformat(string)
+    except ValueError:
+        # fromisoformat does not support all ISO 8601 formats before python 3.11
+        return parse_date(string)
+
+
+def parse_iso_date(string):
+    try:
+        return datetime.date.fromisoformat(string)
+    except ValueError:
+        return parse_iso_datetime(string).date()
+
+
+def prefetch(executor, iterable, func, depth):
+    '''
+    Yield (item, future) pairs in the order of iterable, while func(item) is
+    already computed in background for the next depth items.
+    '''
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) > depth:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        for item, future in pending:
+            future.cancel()
+
+
 class Session(cloudscraper.CloudScraper):
+    def __init__(self, *args, max_workers=10, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # asynchronous requests are run in a pool of threads, so the pool of
+        # connections has to be large enough to serve all of them at once,
+        # plus synchronous requests sent by other threads meanwhile
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        for adapter in self.adapters.values():
+            adapter.init_poolmanager(max_workers, max_workers * 2)
+
     def send(self, *args, **kwargs):
         callback = kwargs.pop('callback', lambda future, response: response)
         is_async = kwargs.pop('is_async', False)
 
-        if is_async:
-            raise ValueError('Async requests are not supported')
+        def func(*args, **kwargs):
+            resp = super(Session, self).send(*args, **kwargs)
+            return callback(self, resp)
 
-        resp = super().send(*args, **kwargs)
+        if is_async:
+            return self.executor.submit(func, *args, **kwargs)
 
-        return callback(self, resp)
+        return func(*args, **kwargs)
 
 
 class LoginPage(JsonPage):
@@ -144,22 +199,63 @@ class CenterPage(HTMLPage):
     pass
 
 
-class CenterBookingPage(JsonPage):
-    def find_motive(self, regex, singleShot=False):
-        for s in self.doc['data']['visit_motives']:
-            # ignore case as some doctors use their own spelling
-            if re.search(regex, s['name'], re.IGNORECASE):
+class MotiveMatcher:
+    """
+    Find the visit motives of a center matching several vaccines at once.
+    """
+
+    def __init__(self, vaccines):
+        # ignore case as some doctors use their own spelling
+        self.patterns = dict((vaccine, re.compile(vaccine, re.IGNORECASE)) for vaccine in vaccines)
+
+    def match(self, visit_motives, vaccines, single_shot_vaccines=()):
+        """
+        Return the motive id of each vaccine, and messages about the skipped motives.
+        """
+        patterns = []
+        for vaccine in vaccines:
+            if vaccine not in self.patterns:
+                self.patterns[vaccine] = re.compile(vaccine, re.IGNORECASE)
+            patterns.append((vaccine, self.patterns[vaccine]))
+
+        motives_id = {}
+        messages = []
+        for s in visit_motives:
+            for vaccine, pattern in patterns:
+                if vaccine in motives_id or not pattern.search(s['name']):
+                    continue
                 if s['allow_new_patients'] == False:
-                    log('Motive %s not allowed for new patients at this center. Skipping vaccine...',
-                        s['name'], flush=True)
+                    messages.append(('Motive %s not allowed for new patients at this center. Skipping vaccine...', s['name']))
                     continue
-                if not singleShot and not s['first_shot_motive']:
-                    log('Skipping second shot motive %s...',
-                        s['name'], flush=True)
+                if vaccine not in single_shot_vaccines and not s['first_shot_motive']:
+                    messages.append(('Skipping second shot motive %s...', s['name']))
                     continue
-                return s['id']
+                motives_id[vaccine] = s['id']
+
+        # keep the order of vaccines
+        return dict((vaccine, motives_id[vaccine]) for vaccine in vaccines if vaccine in motives_id), messages
 
-        return None
+
+class CenterBookingPage(JsonPage):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (vaccines, single shot vaccines) -> motive ids and skipped motives
+        self.motives_index = {}
+        self.agendas_index = None
+
+    def find_motives(self, matcher, vaccines, single_shot_vaccines=(), verbose=True):
+        key = (tuple(vaccines), tuple(single_shot_vaccines))
+        try:
+            motives_id, messages = self.motives_index[key]
+        except KeyError:
+            motives_id, messages = matcher.match(self.doc['data']['visit_motives'], vaccines, single_shot_vaccines)
+            self.motives_index[key] = motives_id, messages
+
+        if verbose:
+            for message, name in messages:
+                log(message, name, flush=True)
+
+        return motives_id
 
     def get_motives(self):
         return [s['name'] for s in self.doc['data']['visit_motives']]
@@ -171,30 +267,179 @@ class CenterBookingPage(JsonPage):
         return self.doc['data']['places'][0]['practice_ids'][0]
 
     def get_agenda_ids(self, motive_id, practice_id=None):
-        agenda_ids = []
-        for a in self.doc['data']['agendas']:
-            if motive_id in a['visit_motive_ids'] and \
-               not a['booking_disabled'] and \
-               (not practice_id or a['practice_id'] == practice_id):
-                agenda_ids.append(str(a['id']))
+        if self.agendas_index is None:
+            # (motive_id, practice_id) -> agenda ids, with practice_id=None for all practices
+            agendas_index = {}
+            for a in self.doc['data']['agendas']:
+                if a['booking_disabled']:
+                    continue
+                for m in a['visit_motive_ids']:
+                    agendas_index.setdefault((m, None), []).append(str(a['id']))
+                    agendas_index.setdefault((m, a.get('practice_id')), []).append(str(a['id']))
+            self.agendas_index = agendas_index
 
-        return agenda_ids
+        return list(self.agendas_index.get((motive_id, practice_id or None), []))
 
     def get_profile_id(self):
         return self.doc['data']['profile']['id']
 
 
-class AvailabilitiesPage(JsonPage):
-    def find_best_slot(self, start_date=None, end_date=None, excluded_weekdays=[]):
-        for a in self.doc['availabilities']:
-            date = parse_date(a['date']).date()
-            if start_date and date < start_date or end_date and date > end_date:
-                continue
-            if date.weekday() in excluded_weekdays:
+class Slot:
+    """
+    Slot of an appointment, with the dates of its first and second shots.
+    """
+
+    __slots__ = ('first', 'second', 'date', 'minute', 'timestamp', 'second_timestamp', 'seen_at')
+
+    def __init__(self, first, second=None):
+        self.first = first
+        self.second = second
+        # when the slot has been received from Doctolib
+        self.seen_at = None
+
+        start = parse_iso_datetime(first)
+        self.date = start.date()
+        # local time of the center
+        self.minute = start.hour * 60 + start.minute
+        self.timestamp = start.timestamp()
+        self.second_timestamp = parse_iso_datetime(second).timestamp() if second else None
+
+    @classmethod
+    def from_doc(cls, slot):
+        # depending on the country, the slot is returned in a different format. Go figure...
+        if isinstance(slot, dict) and 'start_date' in slot:
+            steps = slot.get('steps') or []
+            if len(steps) > 1 and 'start_date' in steps[1]:
+                return cls(slot['start_date'], steps[1]['start_date'])
+            return cls(slot['start_date'])
+        if isinstance(slot, str):
+            # should be for Janssen, second or third shots only, otherwise it is a list
+            return cls(slot)
+        if isinstance(slot, list) and len(slot) > 0:
+            return cls(slot[0], slot[1] if len(slot) > 1 else None)
+        return None
+
+    def __repr__(self):
+        return '<Slot %s %s>' % (self.first, self.second)
+
+
+class SlotConstraints:
+    """
+    Constraints on slots: range of dates and excluded weekdays of the first
+    shot, its time of day as (start_minute, end_minute), and the minimum and
+    maximum number of days between the two shots.
+    """
+
+    def __init__(self, start_date=None, end_date=None, excluded_weekdays=(), time_of_day=None,
+                 min_dose_gap=None, max_dose_gap=None):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.excluded_weekdays = frozenset(excluded_weekdays)
+        self.time_of_day = time_of_day
+        self.min_dose_gap = min_dose_gap * 86400 if min_dose_gap is not None else None
+        self.max_dose_gap = max_dose_gap * 86400 if max_dose_gap is not None else None
+
+    def check_gap(self, first_timestamp, second_timestamp):
+        gap = second_timestamp - first_timestamp
+        return not (self.min_dose_gap is not None and gap < self.min_dose_gap or
+                    self.max_dose_gap is not None and gap > self.max_dose_gap)
+
+    def filter(self, days):
+        """
+        Return the slots of the (date, slots) days which match all constraints.
+        """
+        start_minute, end_minute = self.time_of_day or (0, 24 * 60)
+        min_gap, max_gap = self.min_dose_gap, self.max_dose_gap
+        check_gap = min_gap is not None or max_gap is not None
+
+        result = []
+        for date, slots in days:
+            if self.start_date and date < self.start_date or self.end_date and date > self.end_date:
                 continue
-            if len(a['slots']) == 0:
+            if date.weekday() in self.excluded_weekdays:
                 continue
-            return a['slots'][-1]
+            for slot in slots:
+                if not start_minute <= slot.minute <= end_minute:
+                    continue
+                if check_gap and slot.second_timestamp is not None:
+                    gap = slot.second_timestamp - slot.timestamp
+                    if min_gap is not None and gap < min_gap or max_gap is not None and gap > max_gap:
+                        continue
+                result.append(slot)
+        return result
+
+
+class AvailabilitiesPage(JsonPage):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.days = None
+        self.received_at = time()
+        # days merged from other windows have been received at another time
+        self.received_at_by_date = {}
+
+    def get_days(self):
+        """
+        Return the (date, slots) of each day, with slots parsed once.
+        """
+        if self.days is None:
+            days = []
+            for a in self.doc['availabilities']:
+                received_at = self.received_at_by_date.get(a['date'], self.received_at)
+                slots = []
+                for slot in a['slots']:
+                    slot = Slot.from_doc(slot)
+                    if slot is not None:
+                        slot.seen_at = received_at
+                        slots.append(slot)
+                days.append((parse_iso_date(a['date']), slots))
+            self.days = days
+        return self.days
+
+    def merge(self, page):
+        """
+        Add the availabilities of another window, keeping them sorted by date.
+        """
+        days = dict((a['date'], a) for a in self.doc['availabilities'])
+        for a in page.doc['availabilities']:
+            if a['date'] not in days or len(a['slots']) > 0:
+                days[a['date']] = a
+                self.received_at_by_date[a['date']] = page.received_at_by_date.get(a['date'], page.received_at)
+        self.doc['availabilities'] = [days[date] for date in sorted(days)]
+        self.days = None
+
+        if 'next_slot' in page.doc:
+            self.doc['next_slot'] = page.doc['next_slot']
+        else:
+            self.doc.pop('next_slot', None)
+
+    def iter_slots(self, constraints=None, policy='latest', preferred_hours=None):
+        """
+        Yield slots matching constraints from the best to the worst one.
+
+        The 'latest' policy prefers the earliest day but the latest time in the
+        day, the 'earliest' one the earliest time. Slots within preferred_hours
+        (start_hour, end_hour) come first.
+        """
+        slots = (constraints or SlotConstraints()).filter(self.get_days())
+
+        if policy == 'earliest':
+            def key(slot):
+                return slot.timestamp
+        else:
+            def key(slot):
+                return (slot.date, -slot.minute)
+
+        if preferred_hours:
+            start_minute, end_minute = preferred_hours[0] * 60, preferred_hours[1] * 60
+            policy_key = key
+
+            def key(slot):
+                return (not start_minute <= slot.minute < end_minute, policy_key(slot))
+
+        yield from sorted(slots, key=key)
+
+    def find_best_slot(self, start_date=None, end_date=None, excluded_weekdays=[]):
+        return next(self.iter_slots(SlotConstraints(start_date, end_date, excluded_weekdays)), None)
 
 
 class AppointmentPage(JsonPage):
@@ -228,14 +473,596 @@ class WaitingInQueue(Exception):
     pass
 
 
+class SlotUnavailable(Exception):
+    pass
+
+
 class CityNotFound(Exception):
     pass
 
 
+class BookingGate:
+    """
+    Lookups of availabilities destroy our temporary appointments, which must
+    not happen while one is being booked.
+
+    A booking waits for such lookups in progress, and lookups started
+    meanwhile keep temporary appointments.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.booking = False
+        self.lookups = 0
+
+    @contextmanager
+    def lookup(self):
+        with self.condition:
+            destroy_temporary = not self.booking
+            if destroy_temporary:
+                self.lookups += 1
+        try:
+            yield destroy_temporary
+        finally:
+            if destroy_temporary:
+                with self.condition:
+                    self.lookups -= 1
+                    self.condition.notify_all()
+
+    @contextmanager
+    def book(self):
+        with self.condition:
+            self.booking = True
+            self.condition.wait_for(lambda: self.lookups == 0)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.booking = False
+
+
+class CenterProbe:
+    """
+    Booking profile of a center, and availabilities of its places being
+    looked up concurrently, by (motive_id, practice_id).
+    """
+
+    def __init__(self, center_page):
+        self.center_page = center_page
+        self.availabilities = {}
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+        for future in self.availabilities.values():
+            future.cancel()
+
+
+class DocumentCache:
+    """
+    In-memory LRU cache of documents, whose entries expire after ttl seconds.
+
+    When they are JSON documents, they can be persisted in a file between runs.
+    """
+
+    def __init__(self, ttl, max_size=1000, filename=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.filename = filename
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        key = str(key)
+        with self.lock:
+            try:
+                timestamp, value = self.entries[key]
+            except KeyError:
+                return None
+
+            if time() - timestamp >= self.ttl:
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if not self.ttl:
+            return
+
+        key = str(key)
+        with self.lock:
+            self.entries[key] = (time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def load(self):
+        if not self.filename:
+            return
+        try:
+            with open(self.filename, 'r') as fp:
+                entries = json.load(fp)
+        except (IOError, ValueError):
+            return
+
+        now = time()
+        for key, (timestamp, value) in entries.items():
+            if now - timestamp < self.ttl:
+                self.entries[key] = (timestamp, value)
+
+    def save(self):
+        if not self.filename:
+            return
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with open(self.filename, 'w') as fp:
+            json.dump(self.entries, fp)
+
+
+class CustomFieldAnswers:
+    """
+    Answers to the custom fields of appointments, by patient and then by
+    field id and by label, so they are not asked again while a slot is held.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # patient id -> {'ids': {...}, 'labels': {...}}
+        self.patients = {}
+        self.changed = False
+
+    def get(self, patient_id, field):
+        answers = self.patients.get(str(patient_id))
+        if answers is None:
+            return None
+        if field['id'] in answers['ids']:
+            return answers['ids'][field['id']]
+        return answers['labels'].get(field.get('label'))
+
+    def set(self, patient_id, field, value):
+        answers = self.patients.setdefault(str(patient_id), {'ids': {}, 'labels': {}})
+        answers['ids'][field['id']] = value
+        if field.get('label'):
+            answers['labels'][field['label']] = value
+        self.changed = True
+
+    def load(self):
+        if not self.filename:
+            return
+        try:
+            with open(self.filename, 'r') as fp:
+                answers = json.load(fp)
+        except (IOError, ValueError):
+            return
+
+        for patient_id, patient_answers in answers.items():
+            # answers stored before they were by patient can not be attributed to anyone
+            if not isinstance(patient_answers, dict) or not {'ids', 'labels'} <= set(patient_answers):
+                continue
+            self.patients[patient_id] = {'ids': dict(patient_answers['ids']), 'labels': dict(patient_answers['labels'])}
+
+    def save(self):
+        if not self.filename or not self.changed:
+            return
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(self.filename, 'w') as fp:
+            json.dump(self.patients, fp, indent=2)
+        self.changed = False
+
+
+class SoundSink:
+    def __init__(self, filename='ding.mp3', events=('slot_held',)):
+        self.filename = filename
+        self.events = events
+
+    def send(self, event, message):
+        if event in self.events:
+            playsound(self.filename)
+
+
+class DesktopSink:
+    def send(self, event, message):
+        subprocess.run(['notify-send', 'Doctoshotgun', message], timeout=10, check=False)
+
+
+class FileSink:
+    def __init__(self, filename):
+        self.filename = filename
+
+    def send(self, event, message):
+        with open(self.filename, 'a') as fp:
+            fp.write('[%s] %s: %s\n' % (datetime.datetime.now().isoformat(' ', 'seconds'), event, message))
+
+
+class WebhookSink:
+    def __init__(self, url):
+        self.url = url
+
+    def send(self, event, message):
+        requests.post(self.url, json={'event': event, 'message': message}, timeout=10)
+
+
+class Notifier:
+    """
+    Deliver notifications to sinks from a background thread, so booking
+    never waits for a sound to be played or a webhook to answer.
+    """
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def notify(self, event, message):
+        if not self.sinks:
+            return
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='notifier', daemon=True)
+                self.thread.start()
+        self.queue.put((event, message))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            for sink in self.sinks:
+                try:
+                    sink.send(*item)
+                except Exception as e:
+                    # a notification is never worth crashing
+                    logging.debug('Unable to notify with %s: %s', type(sink).__name__, e)
+
+    def close(self, timeout=5):
+        """
+        Wait for pending notifications to be delivered.
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join(timeout)
+
+
+class RequestMetrics:
+    """
+    Latency, status, size and retries of responses, by endpoint.
+
+    Aggregates can be exported periodically as JSON and in the Prometheus
+    text format.
+    """
+
+    # latencies kept by endpoint to compute percentiles
+    MAX_SAMPLES = 10000
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def record(self, endpoint, latency, status, size, retries=0):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {'latencies': deque(maxlen=self.MAX_SAMPLES),
+                                                    'count': 0,
+                                                    'latency_sum': 0.0,
+                                                    'bytes': 0,
+                                                    'retries': 0,
+                                                    'statuses': {},
+                                                    }
+            stats['latencies'].append(latency)
+            stats['count'] += 1
+            stats['latency_sum'] += latency
+            stats['bytes'] += size
+            stats['retries'] += retries
+            stats['statuses'][str(status)] = stats['statuses'].get(str(status), 0) + 1
+
+    @staticmethod
+    def percentile(values, percent):
+        # nearest-rank method
+        index = max(0, -(-len(values) * percent // 100) - 1)
+        return values[index]
+
+    def summary(self):
+        summary = {}
+        with self.lock:
+            for endpoint, stats in sorted(self.endpoints.items()):
+                latencies = sorted(stats['latencies'])
+                summary[endpoint] = {'count': stats['count'],
+                                     'latency_sum': stats['latency_sum'],
+                                     'bytes': stats['bytes'],
+                                     'retries': stats['retries'],
+                                     'statuses': dict(stats['statuses']),
+                                     }
+                for percent in self.PERCENTILES:
+                    summary[endpoint]['p%s' % percent] = self.percentile(latencies, percent)
+        return summary
+
+    def to_prometheus(self):
+        summary = self.summary()
+        lines = ['# TYPE doctoshotgun_request_duration_seconds summary']
+        for endpoint, stats in summary.items():
+            for percent in self.PERCENTILES:
+                lines.append('doctoshotgun_request_duration_seconds{endpoint="%s",quantile="%s"} %f' % (endpoint, percent / 100, stats['p%s' % percent]))
+            lines.append('doctoshotgun_request_duration_seconds_sum{endpoint="%s"} %f' % (endpoint, stats['latency_sum']))
+            lines.append('doctoshotgun_request_duration_seconds_count{endpoint="%s"} %d' % (endpoint, stats['count']))
+
+        lines.append('# TYPE doctoshotgun_responses_total counter')
+        for endpoint, stats in summary.items():
+            for status, count in sorted(stats['statuses'].items()):
+                lines.append('doctoshotgun_responses_total{endpoint="%s",status="%s"} %d' % (endpoint, status, count))
+
+        for name, key in (('doctoshotgun_response_bytes_total', 'bytes'), ('doctoshotgun_request_retries_total', 'retries')):
+            lines.append('# TYPE %s counter' % name)
+            for endpoint, stats in summary.items():
+                lines.append('%s{endpoint="%s"} %d' % (name, endpoint, stats[key]))
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self, json_filename=None, prometheus_filename=None):
+        # files are replaced at once, so they can be read at any time
+        for filename, content in ((json_filename, lambda: json.dumps(self.summary(), indent=2)),
+                                  (prometheus_filename, self.to_prometheus)):
+            if not filename:
+                continue
+            tmp_filename = '%s.tmp' % filename
+            with open(tmp_filename, 'w') as fp:
+                fp.write(content())
+            os.replace(tmp_filename, filename)
+
+    def start_export(self, json_filename=None, prometheus_filename=None, interval=60):
+        def run():
+            while not self.stopped.wait(interval):
+                self.export(json_filename, prometheus_filename)
+            self.export(json_filename, prometheus_filename)
+
+        self.thread = threading.Thread(target=run, name='metrics', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class BookingAttempt:
+    """
+    Time spent in each step of a booking attempt, which started when its
+    slot has been received.
+    """
+
+    def __init__(self, seen_at=None):
+        self.seen_at = seen_at or time()
+        self.steps = {}
+        self.outcome = 'error'
+
+    @contextmanager
+    def step(self, name):
+        start = time()
+        try:
+            yield
+        finally:
+            self.steps[name] = self.steps.get(name, 0) + time() - start
+
+
+class BookingLatency:
+    """
+    Time from slots received to booking status, and of each booking step,
+    for all attempts of a run.
+    """
+
+    STEPS = ('appointment', 'second_shot_availabilities', 'appointment_edit', 'prompt', 'appointment_post', 'appointment_confirm')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.attempts = []
+
+    def record(self, attempt):
+        with self.lock:
+            self.attempts.append((attempt.outcome, time() - attempt.seen_at, dict(attempt.steps)))
+
+    @staticmethod
+    def get_percentiles(values):
+        values = sorted(values)
+        return dict(('p%s' % percent, RequestMetrics.percentile(values, percent)) for percent in RequestMetrics.PERCENTILES)
+
+    def summary(self):
+        with self.lock:
+            attempts = list(self.attempts)
+
+        outcomes = {}
+        for outcome, total, steps in attempts:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+        summary = {'attempts': len(attempts), 'outcomes': outcomes, 'steps': {}}
+        if attempts:
+            summary['total'] = self.get_percentiles(total for outcome, total, steps in attempts)
+        for step in self.STEPS:
+            durations = [steps[step] for outcome, total, steps in attempts if step in steps]
+            if durations:
+                summary['steps'][step] = self.get_percentiles(durations)
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        if not summary['attempts']:
+            return
+
+        log('Booking attempts: %s (%s)', summary['attempts'],
+            ', '.join('%s %s' % (count, outcome) for outcome, count in sorted(summary['outcomes'].items())))
+        for name, stats in [('slot to status', summary['total'])] + list(summary['steps'].items()):
+            log('  %s: p50 %s, p95 %s, p99 %s', name, *('%.2fs' % stats['p%s' % percent] for percent in RequestMetrics.PERCENTILES))
+
+
+class Span:
+    __slots__ = ('name', 'attributes', 'id', 'parent', 'start')
+
+    def __init__(self, name, attributes, id, parent):
+        self.name = name
+        self.attributes = attributes
+        self.id = id
+        self.parent = parent
+        self.start = time()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class NullSpan:
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class Tracer:
+    """
+    Write nested spans as complete events of the Trace Event Format, one
+    JSON object per line.
+
+    Spans are nested per thread, functions run by other threads are nested
+    in the span they are submitted from with bind(). When no file is opened,
+    spans cost nothing more than a method call.
+    """
+
+    NULL_SPAN = NullSpan()
+
+    def __init__(self, filename=None):
+        self.fp = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+        if filename:
+            self.fp = open(filename, 'a')
+
+    @property
+    def enabled(self):
+        return self.fp is not None
+
+    def span(self, name, **attributes):
+        if self.fp is None:
+            return self.NULL_SPAN
+        return self._span(name, attributes)
+
+    @contextmanager
+    def _span(self, name, attributes):
+        stack = self.get_stack()
+        span = Span(name, attributes, next(self.ids), stack[-1].id if stack else None)
+        stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span.set(error=repr(e))
+            raise
+        finally:
+            stack.pop()
+            self.write(span, time() - span.start)
+
+    def annotate(self, **attributes):
+        """
+        Set attributes of the current span of this thread.
+        """
+        if self.fp is None:
+            return
+        stack = self.get_stack()
+        if stack:
+            stack[-1].set(**attributes)
+
+    def record(self, name, duration, **attributes):
+        """
+        Write a span which has just ended, in the current span of this thread.
+        """
+        if self.fp is None:
+            return
+        stack = self.get_stack()
+        span = Span(name, attributes, next(self.ids), stack[-1].id if stack else None)
+        span.start -= duration
+        self.write(span, duration)
+
+    def bind(self, func):
+        """
+        Return func running in the current span of this thread, so spans of
+        calls from other threads, e.g. of an executor, are nested in it.
+        """
+        if self.fp is None:
+            return func
+        stack = self.get_stack()
+        if not stack:
+            return func
+        # only the id of the parent is used by its children
+        parent = Span(stack[-1].name, {}, stack[-1].id, stack[-1].parent)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = self.get_stack()
+            stack.append(parent)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stack.pop()
+        return wrapper
+
+    def get_stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def write(self, span, duration):
+        event = {'name': span.name,
+                 'ph': 'X',
+                 'ts': int(span.start * 1e6),
+                 'dur': int(duration * 1e6),
+                 'pid': os.getpid(),
+                 'tid': threading.get_ident(),
+                 'args': dict(span.attributes, id=span.id, parent=span.parent),
+                 }
+        line = json.dumps(event, default=str) + '\n'
+        with self.lock:
+            if self.fp is not None:
+                self.fp.write(line)
+                self.fp.flush()
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+
+def traced(name):
+    """
+    Trace calls of a method with the tracer of its object.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class Doctolib(LoginBrowser, StatesMixin):
     # individual properties for each country. To be defined in subclasses
     BASEURL = ""
     vaccine_motives = {}
+    motive_matcher = MotiveMatcher([])
     centers = URL('')
     center = URL('')
     # common properties
@@ -254,16 +1081,67 @@ class Doctolib(LoginBrowser, StatesMixin):
         r'/appointments/(?P<id>.+).json', AppointmentPostPage)
     master_patient = URL(r'/account/master_patients.json', MasterPatientPage)
 
+    AVAILABILITIES_LIMIT = 3
+    JSON_HEADERS = {'content-type': 'application/json'}
+    # how many slots of a place are tried when they are booked by someone else in the meantime
+    MAX_SLOT_ATTEMPTS = 5
+    # how many slots can be held at the same time, each one being released
+    # only once another is booked
+    MAX_SPECULATIVE_HOLDS = 5
+    # URLs whose responses are measured, other ones are gathered as 'other'
+    METRICS_ENDPOINTS = ('centers', 'center_result', 'center_booking', 'availabilities', 'second_shot_availabilities',
+                         'appointment', 'appointment_edit', 'appointment_post', 'master_patient')
+
     def _setup_session(self, profile):
-        session = Session()
+        session = Session(max_workers=self.MAX_WORKERS)
 
         session.hooks['response'].append(self.set_normalized_url)
+        if self.metrics is not None or self.tracer.enabled:
+            session.hooks['response'].append(self.record_response)
         if self.responses_dirname is not None:
             session.hooks['response'].append(self.save_response)
 
         self.session = session
 
+    def get_endpoint(self, url):
+        for name in self.METRICS_ENDPOINTS:
+            if getattr(self, name).match(url, base=self.BASEURL):
+                return name
+        return 'other'
+
+    def record_response(self, response, *args, **kwargs):
+        endpoint = self.get_endpoint(response.url)
+        latency = response.elapsed.total_seconds()
+
+        self.tracer.record('%s %s' % (response.request.method, endpoint), latency,
+                           url=urlparse(response.url).path, status=response.status_code)
+
+        if self.metrics is not None:
+            retries = getattr(response.raw, 'retries', None)
+            self.metrics.record(endpoint, latency, response.status_code, len(response.content),
+                                len(retries.history) if retries else 0)
+
     def __init__(self, *args, **kwargs):
+        max_workers = kwargs.pop('max_workers', None)
+        if max_workers:
+            self.MAX_WORKERS = max_workers
+        self.search_results = kwargs.pop('search_results', None) or DocumentCache(ttl=0)
+        self.booking_profiles = kwargs.pop('booking_profiles', None) or DocumentCache(ttl=0)
+        self.booking_gate = BookingGate()
+        self.metrics = kwargs.pop('metrics', None)
+        self.booking_latency = kwargs.pop('booking_latency', None) or BookingLatency()
+        self.tracer = kwargs.pop('tracer', None) or Tracer()
+        self.notifier = kwargs.pop('notifier', None) or Notifier([SoundSink()])
+        self.slot_policy = kwargs.pop('slot_policy', 'latest')
+        self.preferred_hours = kwargs.pop('preferred_hours', None)
+        self.time_of_day = kwargs.pop('time_of_day', None)
+        self.dose_gap = kwargs.pop('dose_gap', (None, None))
+        self.trust_second_slot = kwargs.pop('trust_second_slot', False)
+        self.speculative_holds = min(kwargs.pop('speculative_holds', 1), self.MAX_SPECULATIVE_HOLDS)
+        # holds must not wait behind the availabilities lookups of the session
+        self.hold_executor = ThreadPoolExecutor(max_workers=self.MAX_SPECULATIVE_HOLDS)
+        self.custom_field_answers = kwargs.pop('custom_field_answers', None) or CustomFieldAnswers()
+
         super().__init__(*args, **kwargs)
         self.session.headers['sec-fetch-dest'] = 'document'
         self.session.headers['sec-fetch-mode'] = 'navigate'
@@ -271,6 +1149,7 @@ class Doctolib(LoginBrowser, StatesMixin):
         self.session.headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.4389.114 Safari/537.36'
 
         self.patient = None
+        self.booking_data = None
 
     def locate_browser(self, state):
         # When loading state, do not locate browser on the last url.
@@ -319,43 +1198,70 @@ class Doctolib(LoginBrowser, StatesMixin):
         if motives is None:
             motives = self.vaccine_motives.keys()
         for city in where:
-            try:
-                self.centers.go(where=city, params={
-                                'ref_visit_motive_ids[]': motives, 'page': page})
-            except ServerError as e:
-                if e.response.status_code in [503]:
-                    if 'text/html' in e.response.headers['Content-Type'] \
-                        and ('cloudflare' in e.response.text or
-                             'Checking your browser before accessing' in e .response.text):
-                        log('Request blocked by CloudFlare', color='red')
-                    return
-                if e.response.status_code in [520]:
-                    log('Cloudflare is unable to connect to Doctolib server. Please retry later.', color='red')
-                    return
-                raise
-            except HTTPNotFound as e:
-                raise CityNotFound(city) from e
-
-            next_page = self.page.get_next_page()
-
-            for i in self.page.iter_centers_ids():
-                page = self.center_result.open(
-                    id=i,
-                    params={
-                        'limit': '4',
-                        'ref_visit_motive_ids[]': motives,
-                        'speciality_id': '5494',
-                        'search_result_format': 'json'
-                    }
-                )
+            # each city has its own pagination, which ends when there is no next page
+            future = self.centers.open(where=city, params={
+                                       'ref_visit_motive_ids[]': motives, 'page': page}, is_async=True)
+            while future:
                 try:
-                    yield page.doc['search_result']
-                except KeyError:
-                    pass
+                    with self.tracer.span('centers', city=city):
+                        centers_page = future.result().page
+                        centers_page.on_load()
+                except ServerError as e:
+                    if e.response.status_code in [503]:
+                        if 'text/html' in e.response.headers['Content-Type'] \
+                            and ('cloudflare' in e.response.text or
+                                 'Checking your browser before accessing' in e .response.text):
+                            log('Request blocked by CloudFlare', color='red')
+                        return
+                    if e.response.status_code in [520]:
+                        log('Cloudflare is unable to connect to Doctolib server. Please retry later.', color='red')
+                        return
+                    raise
+                except HTTPNotFound as e:
+                    raise CityNotFound(city) from e
+
+                # fetch the next page while centers of this one are processed
+                next_page = centers_page.get_next_page()
+                if next_page:
+                    future = self.centers.open(where=city, params={
+                                               'ref_visit_motive_ids[]': motives, 'page': next_page}, is_async=True)
+                else:
+                    future = None
+
+                # fetch all centers of the page which are not in cache at once,
+                # but yield them in the page order
+                futures = []
+                for i in centers_page.iter_centers_ids():
+                    search_result = self.search_results.get(i)
+                    if search_result is None:
+                        search_result = self.center_result.open(
+                            id=i,
+                            params={
+                                'limit': '4',
+                                'ref_visit_motive_ids[]': motives,
+                                'speciality_id': '5494',
+                                'search_result_format': 'json'
+                            },
+                            is_async=True
+                        )
+                    futures.append((i, search_result))
+
+                for i, search_result in futures:
+                    if isinstance(search_result, dict):
+                        yield search_result
+                        continue
 
-            if next_page:
-                for center in self.find_centers(where, motives, next_page):
-                    yield center
+                    try:
+                        center_page = search_result.result().page
+                    except ServerError as e:
+                        log('Center %s: %s', i, e, color='red')
+                        continue
+                    try:
+                        search_result = center_page.doc['search_result']
+                    except KeyError:
+                        continue
+                    self.search_results.set(i, search_result)
+                    yield search_result
 
     def get_patients(self):
         self.master_patient.go()
@@ -370,167 +1276,511 @@ class Doctolib(LoginBrowser, StatesMixin):
         normalized = re.sub(r'\W', '-', normalized)
         return normalized.lower()
 
-    def try_to_book(self, center, vaccine_list, start_date, end_date, excluded_weekdays, only_second, only_third, dry_run=False, confirm=False):
-        try:
+    def find_motives(self, center_page, vaccine_list, only_second, only_third, verbose=True):
+        # extract motive ids based on the vaccine names
+        single_shot_vaccines = [vaccine for vaccine in vaccine_list
+                                if vaccine == self.vaccine_motives[self.KEY_JANSSEN] or only_second or only_third]
+        return center_page.find_motives(self.motive_matcher, vaccine_list, single_shot_vaccines, verbose)
+
+    def find_agenda_ids(self, center_page, motive_id, practice_id):
+        agenda_ids = center_page.get_agenda_ids(motive_id, practice_id)
+        if len(agenda_ids) == 0:
+            # do not filter to give a chance
+            agenda_ids = center_page.get_agenda_ids(motive_id)
+        return agenda_ids
+
+    def get_slot_constraints(self, start_date, end_date, excluded_weekdays=()):
+        return SlotConstraints(start_date, end_date, excluded_weekdays, self.time_of_day, *self.dose_gap)
+
+    def find_second_slot(self, page, slot_date_first):
+        """
+        Return the best second shot slot of page whose gap to the first shot
+        matches the dose gap.
+        """
+        constraints = self.get_slot_constraints(None, None)
+        first_timestamp = Slot(slot_date_first).timestamp
+        for slot in page.iter_slots():
+            if constraints.check_gap(first_timestamp, slot.timestamp):
+                return slot
+        return None
+
+    def get_availabilities_windows(self, start_date, end_date):
+        # each request returns the availabilities of AVAILABILITIES_LIMIT days
+        windows = []
+        date = start_date
+        while date <= end_date:
+            windows.append(date)
+            date += datetime.timedelta(days=self.AVAILABILITIES_LIMIT)
+        return windows
+
+    @traced('find_availabilities')
+    def find_availabilities(self, motive_id, practice_id, agenda_ids, start_date, end_date, cancelled=None, excluded_weekdays=()):
+        constraints = self.get_slot_constraints(start_date, end_date, excluded_weekdays)
+        page = None
+        windows = self.get_availabilities_windows(start_date, end_date)
+        self.tracer.annotate(motive_id=motive_id, practice_id=practice_id, windows=len(windows))
+        i = 0
+        while i < len(windows):
+            if cancelled is not None and cancelled.is_set():
+                return None
+
+            with self.booking_gate.lookup() as destroy_temporary:
+                window = self.availabilities.open(
+                    params={'start_date': windows[i].strftime('%Y-%m-%d'),
+                            'visit_motive_ids': motive_id,
+                            'agenda_ids': '-'.join(agenda_ids),
+                            'insurance_sector': 'public',
+                            'practice_ids': practice_id,
+                            'destroy_temporary': 'true' if destroy_temporary else 'false',
+                            'limit': self.AVAILABILITIES_LIMIT})
+
+            # all windows are merged in the same page to select the slot among all of them
+            if page is None:
+                page = window
+            else:
+                page.merge(window)
+
+            if 'next_slot' not in window.doc:
+                # an empty window without next_slot means there is nothing later,
+                # only slots rejected by the constraints are worth looking further
+                if next(page.iter_slots(constraints), None) or not any(slots for date, slots in window.get_days()):
+                    break
+                i += 1
+                continue
+
+            # there is no availability before next_slot, so go directly to its window
+            next_slot = parse_iso_date(window.doc['next_slot'])
+            if next_slot > end_date:
+                break
+            i = max(i + 1, (next_slot - start_date).days // self.AVAILABILITIES_LIMIT)
+
+        return page
+
+    @traced('probe_center')
+    def probe_center(self, center, vaccine_list, start_date, end_date, only_second, only_third, excluded_weekdays=()):
+        """
+        Fetch the booking profile of a center and start to look up the
+        availabilities of all its places, without changing the state of the
+        browser, so it can be run in background while other centers are
+        processed.
+        """
+        p = urlparse(center['url'])
+        center_id = p.path.split('/')[-1]
+        self.tracer.annotate(center_id=center_id)
+
+        # the center page is only requested to detect centers which do not
+        # exist anymore, which can not be the case of recently cached ones
+        center_page = self.booking_profiles.get(center_id)
+        if center_page is None:
             self.open(center['url'])
-        except ClientError as e:
+            center_page = self.center_booking.open(center_id=center_id)
+            self.booking_profiles.set(center_id, center_page)
+
+        motives_id = self.find_motives(center_page, vaccine_list, only_second, only_third, verbose=False)
+
+        probe = CenterProbe(center_page)
+        find_availabilities = self.tracer.bind(self.find_availabilities)
+        for place in center_page.get_places():
+            practice_id = place['practice_ids'][0]
+            for motive_id in motives_id.values():
+                if (motive_id, practice_id) in probe.availabilities:
+                    continue
+                agenda_ids = self.find_agenda_ids(center_page, motive_id, practice_id)
+                probe.availabilities[(motive_id, practice_id)] = self.session.executor.submit(
+                    find_availabilities, motive_id, practice_id, agenda_ids, start_date, end_date, probe.cancelled,
+                    excluded_weekdays)
+
+        return probe
+
+    @traced('try_to_book')
+    def try_to_book(self, center, vaccine_list, start_date, end_date, excluded_weekdays, only_second, only_third, dry_run=False, confirm=False, probe=None):
+        self.tracer.annotate(center=center.get('url'))
+        try:
+            if probe is None:
+                probe = self.probe_center(center, vaccine_list, start_date, end_date, only_second, only_third, excluded_weekdays)
+            else:
+                probe = probe.result()
+        except (ClientError, ServerError) as e:
             # Sometimes there are referenced centers which are not available anymore (410 Gone)
             log('Error: %s', e, color='red')
             return False
 
-        p = urlparse(center['url'])
-        center_id = p.path.split('/')[-1]
-
-        center_page = self.center_booking.go(center_id=center_id)
-        profile_id = self.page.get_profile_id()
-        # extract motive ids based on the vaccine names
-        motives_id = dict()
-        for vaccine in vaccine_list:
-            motives_id[vaccine] = self.page.find_motive(
-                r'.*({})'.format(vaccine), singleShot=(vaccine == self.vaccine_motives[self.KEY_JANSSEN] or only_second or only_third))
+        try:
+            return self._try_to_book_probe(probe, vaccine_list, start_date, end_date, excluded_weekdays, only_second, only_third, dry_run, confirm)
+        finally:
+            # once a slot is booked, or if anything fails, stop looking up other places
+            probe.cancel()
 
-        motives_id = dict((k, v)
-                          for k, v in motives_id.items() if v is not None)
+    def _try_to_book_probe(self, probe, vaccine_list, start_date, end_date, excluded_weekdays, only_second, only_third, dry_run, confirm):
+        center_page = probe.center_page
+        profile_id = center_page.get_profile_id()
+        motives_id = self.find_motives(center_page, vaccine_list, only_second, only_third)
         if len(motives_id.values()) == 0:
             log('Unable to find requested vaccines in motives', color='red')
-            log('Motives: %s', ', '.join(self.page.get_motives()), color='red')
+            log('Motives: %s', ', '.join(center_page.get_motives()), color='red')
             return False
 
-        for place in self.page.get_places():
-            if place['name']:
-                log('– %s...', place['name'])
+        lookups = {}
+        for place in center_page.get_places():
             practice_id = place['practice_ids'][0]
             for vac_name, motive_id in motives_id.items():
-                log('  Vaccine %s...', vac_name, end=' ', flush=True)
-                agenda_ids = center_page.get_agenda_ids(motive_id, practice_id)
-                if len(agenda_ids) == 0:
-                    # do not filter to give a chance
-                    agenda_ids = center_page.get_agenda_ids(motive_id)
+                future = probe.availabilities[(motive_id, practice_id)]
+                if future not in lookups:
+                    lookups[future] = (place, vac_name, motive_id, practice_id)
+
+        # try to book places in the order their availabilities are received
+        last_place = None
+        for future in as_completed(lookups):
+            place, vac_name, motive_id, practice_id = lookups[future]
+            try:
+                availabilities = future.result()
+            except ServerError as e:
+                # only this place is skipped
+                log('  Vaccine %s: %s', vac_name, e, color='red')
+                continue
+            if availabilities is None:
+                continue
 
-                if self.try_to_book_place(profile_id, motive_id, practice_id, agenda_ids, vac_name.lower(), start_date, end_date, excluded_weekdays, only_second, only_third, dry_run, confirm):
-                    return True
+            if place['name'] and place is not last_place:
+                log('– %s...', place['name'])
+            last_place = place
+
+            log('  Vaccine %s...', vac_name, end=' ', flush=True)
+            agenda_ids = self.find_agenda_ids(center_page, motive_id, practice_id)
+
+            if self.try_to_book_place(profile_id, motive_id, practice_id, agenda_ids, vac_name.lower(), start_date, end_date, excluded_weekdays, only_second, only_third, dry_run, confirm,
+                                      availabilities=availabilities):
+                return True
 
         return False
 
-    def try_to_book_place(self, profile_id, motive_id, practice_id, agenda_ids, vac_name, start_date, end_date, excluded_weekdays, only_second, only_third, dry_run=False, confirm=False):
-        date = start_date.strftime('%Y-%m-%d')
-        while date is not None:
-            self.availabilities.go(
-                params={'start_date': date,
-                        'visit_motive_ids': motive_id,
-                        'agenda_ids': '-'.join(agenda_ids),
-                        'insurance_sector': 'public',
-                        'practice_ids': practice_id,
-                        'destroy_temporary': 'true',
-                        'limit': 3})
-            if 'next_slot' in self.page.doc:
-                date = self.page.doc['next_slot']
-            else:
-                date = None
+    def find_candidates(self, center, probe, vaccine_list, start_date, end_date, excluded_weekdays, only_second, only_third):
+        """
+        Return (score, candidate) for every slot of a probed center matching
+        the constraints, the lowest score being the best one.
+        """
+        center_page = probe.center_page
+        profile_id = center_page.get_profile_id()
+        motives_id = self.find_motives(center_page, vaccine_list, only_second, only_third, verbose=False)
+        constraints = self.get_slot_constraints(start_date, end_date, excluded_weekdays)
+        distance = self.get_distance(center)
+
+        candidates = []
+        seen = set()
+        for place in center_page.get_places():
+            practice_id = place['practice_ids'][0]
+            for vaccine_rank, (vac_name, motive_id) in enumerate(motives_id.items()):
+                if (motive_id, practice_id) in seen:
+                    continue
+                seen.add((motive_id, practice_id))
 
-        if len(self.page.doc['availabilities']) == 0:
+                try:
+                    availabilities = probe.availabilities[(motive_id, practice_id)].result()
+                except ServerError as e:
+                    # only this place is skipped
+                    log('Center %s: %s', center.get('name_with_title'), e, color='red')
+                    continue
+                if availabilities is None:
+                    continue
+
+                multi_shot = vac_name.lower() != 'janssen' and not only_second and not only_third
+                agenda_ids = self.find_agenda_ids(center_page, motive_id, practice_id)
+                for slot in availabilities.iter_slots(constraints):
+                    if multi_shot and slot.second is None:
+                        continue
+                    candidates.append((self.score_slot(slot, distance, vaccine_rank), {
+                        'center': center,
+                        'place': place,
+                        'vac_name': vac_name,
+                        'profile_id': profile_id,
+                        'motive_id': motive_id,
+                        'practice_id': practice_id,
+                        'agenda_ids': agenda_ids,
+                        'slot': slot,
+                    }))
+        return candidates
+
+    @staticmethod
+    def get_distance(center):
+        try:
+            return float(center.get('distance') or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    def score_slot(self, slot, distance=0, vaccine_rank=0):
+        """
+        Score a slot among all centers, the lowest being the best one.
+
+        Slots within preferred hours come first, then they are compared by
+        day, distance of the center, rank of the vaccine in the requested
+        ones and time in the day according to the slot policy.
+        """
+        out_of_hours = False
+        if self.preferred_hours:
+            start_hour, end_hour = self.preferred_hours
+            out_of_hours = not start_hour * 60 <= slot.minute < end_hour * 60
+
+        time_key = slot.minute if self.slot_policy == 'earliest' else -slot.minute
+        return (out_of_hours, slot.date, distance, vaccine_rank, time_key)
+
+    def book_candidate(self, candidate, only_second, only_third, dry_run=False, confirm=False):
+        slot = candidate['slot']
+        with self.booking_gate.book():
+            return self.book_slot(candidate['profile_id'], candidate['motive_id'], candidate['practice_id'], candidate['agenda_ids'],
+                                  candidate['vac_name'].lower(), slot.first, slot.second, only_second, only_third, dry_run, confirm,
+                                  attempt=BookingAttempt(slot.seen_at))
+
+    @traced('try_to_book_place')
+    def try_to_book_place(self, profile_id, motive_id, practice_id, agenda_ids, vac_name, start_date, end_date, excluded_weekdays, only_second, only_third, dry_run=False, confirm=False, availabilities=None):
+        self.tracer.annotate(profile_id=profile_id, motive_id=motive_id, practice_id=practice_id, vaccine=vac_name)
+        if availabilities is None:
+            availabilities = self.find_availabilities(motive_id, practice_id, agenda_ids, start_date, end_date,
+                                                      excluded_weekdays=excluded_weekdays)
+            if availabilities is None:
+                log('no availabilities', color='red')
+                return False
+
+        if len(availabilities.doc['availabilities']) == 0:
             log('no availabilities', color='red')
             return False
 
-        slot = self.page.find_best_slot(start_date, end_date)
-        if not slot:
+        constraints = self.get_slot_constraints(start_date, end_date, excluded_weekdays)
+        slots = list(availabilities.iter_slots(constraints, self.slot_policy, self.preferred_hours))
+        if not slots:
             if only_second == False and only_third == False:
                 log('First slot not found :(', color='red')
             else:
                 log('Slot not found :(', color='red')
             return False
 
-        # depending on the country, the slot is returned in a different format. Go figure...
-        if isinstance(slot, dict) and 'start_date' in slot:
-            slot_date_first = slot['start_date']
-            if vac_name != "janssen":
-                slot_date_second = slot['steps'][1]['start_date']
-        elif isinstance(slot, str):
-            if vac_name != "janssen" and not only_second and not only_third:
-                log('Only one slot for multi-shot vaccination found')
-            # should be for Janssen, second or third shots only, otherwise it is a list
-            slot_date_first = slot
-        elif isinstance(slot, list):
-            slot_date_first = slot[0]
-            if vac_name != "janssen":  # maybe redundant?
-                slot_date_second = slot[1]
-        else:
-            log('Error while fetching first slot.', color='red')
-            return False
         if vac_name != "janssen" and not only_second and not only_third:
-            assert slot_date_second
+            slots = [slot for slot in slots if slot.second is not None]
+            if not slots:
+                log('Only one slot for multi-shot vaccination found', color='red')
+                return False
         log('found!', color='green')
-        log('  ├╴ Best slot found: %s', parse_date(
-            slot_date_first).strftime('%c'))
 
+        if self.speculative_holds > 1:
+            candidates = [{'profile_id': profile_id,
+                           'motive_id': motive_id,
+                           'practice_id': practice_id,
+                           'agenda_ids': agenda_ids,
+                           'vac_name': vac_name,
+                           'slot': slot,
+                           } for slot in slots[:self.speculative_holds]]
+            return self.book_speculatively(candidates, only_second, only_third, dry_run, confirm)
+
+        # when a slot is taken by someone else in the meantime, directly try the next one
+        for i, slot in enumerate(slots[:self.MAX_SLOT_ATTEMPTS]):
+            if i == 0:
+                log('  ├╴ Best slot found: %s', parse_iso_datetime(slot.first).strftime('%c'))
+            else:
+                log('  ├╴ Next slot: %s', parse_iso_datetime(slot.first).strftime('%c'))
+
+            try:
+                with self.booking_gate.book():
+                    return self.book_slot(profile_id, motive_id, practice_id, agenda_ids, vac_name, slot.first, slot.second, only_second, only_third, dry_run, confirm,
+                                          attempt=BookingAttempt(slot.seen_at))
+            except SlotUnavailable as e:
+                log('  ├╴ Appointment not available anymore :( %s', e)
+
+        log('  └╴ No other slot to try')
+        return False
+
+    def prepare_booking(self):
+        """
+        Return the part of the appointment confirmation which only depends
+        on the patient, built once by patient.
+        """
+        if self.booking_data is not None and self.booking_data['master_patient'] is self.patient:
+            return self.booking_data
+
+        self.booking_data = {'appointment': {'custom_fields_values': {},
+                                             'new_patient': True,
+                                             'qualification_answers': {},
+                                             'referrer_id': None,
+                                             },
+                             'bypass_mandatory_relative_contact_info': False,
+                             'email': None,
+                             'master_patient': self.patient,
+                             'new_patient': True,
+                             'patient': None,
+                             'phone_number': None,
+                             }
+        return self.booking_data
+
+    def get_appointment_data(self, profile_id, motive_id, practice_id, agenda_ids, slot_date_first):
         appointment = {'profile_id':    profile_id,
                        'source_action': 'profile',
                        'start_date':    slot_date_first,
                        'visit_motive_ids': str(motive_id),
                        }
 
-        data = {'agenda_ids': '-'.join(agenda_ids),
+        return {'agenda_ids': '-'.join(agenda_ids),
                 'appointment': appointment,
                 'practice_ids': [practice_id]}
 
-        headers = {
-            'content-type': 'application/json',
-        }
-        self.appointment.go(data=json.dumps(data), headers=headers)
+    def hold_slot(self, candidate, attempt):
+        """
+        Create the temporary appointment of a candidate slot, without
+        changing the state of the browser, and return its id.
+        """
+        data = self.get_appointment_data(candidate['profile_id'], candidate['motive_id'], candidate['practice_id'],
+                                         candidate['agenda_ids'], candidate['slot'].first)
+        with attempt.step('appointment'):
+            page = self.appointment.open(data=json.dumps(data), headers=self.JSON_HEADERS)
+        if page.is_error():
+            raise SlotUnavailable(page.get_error())
+        return page.doc['id']
+
+    def release_appointment(self, appointment_id):
+        # this endpoint is not documented, if it does not work the
+        # appointment is only released when it expires
+        try:
+            self.appointment_post.open(id=appointment_id, method='DELETE')
+        except (ClientError, ServerError, ConnectionError, ReadTimeout) as e:
+            logging.debug('Unable to release appointment %s: %s', appointment_id, e)
+
+    @traced('book_speculatively')
+    def book_speculatively(self, candidates, only_second, only_third, dry_run=False, confirm=False):
+        """
+        Hold slots of all candidates at the same time, and complete the
+        booking of the first one held. Other holds are released.
+        """
+        with self.booking_gate.book():
+            holds = {}
+            for candidate in candidates:
+                attempt = BookingAttempt(candidate['slot'].seen_at)
+                holds[self.hold_executor.submit(self.hold_slot, candidate, attempt)] = (candidate, attempt)
+            log('  ├╴ Holding %s slots...', len(holds))
+
+            booked = False
+            for future in as_completed(holds):
+                candidate, attempt = holds[future]
+                slot_date = parse_iso_datetime(candidate['slot'].first).strftime('%c')
+                try:
+                    appointment_id = future.result()
+                except SlotUnavailable as e:
+                    log('  ├╴ %s not available anymore :( %s', slot_date, e)
+                    attempt.outcome = 'unavailable'
+                    self.booking_latency.record(attempt)
+                    continue
+                except (ClientError, ServerError, ConnectionError, ReadTimeout) as e:
+                    log('  ├╴ Unable to hold %s: %s', slot_date, e)
+                    self.booking_latency.record(attempt)
+                    continue
 
-        if self.page.is_error():
-            log('  └╴ Appointment not available anymore :( %s', self.page.get_error())
-            return False
+                if booked:
+                    self.release_appointment(appointment_id)
+                    attempt.outcome = 'released'
+                    self.booking_latency.record(attempt)
+                    continue
 
-        playsound('ding.mp3')
+                log('  ├╴ Slot held: %s', slot_date)
+                try:
+                    booked = self.book_slot(candidate['profile_id'], candidate['motive_id'], candidate['practice_id'], candidate['agenda_ids'],
+                                            candidate['vac_name'].lower(), candidate['slot'].first, candidate['slot'].second,
+                                            only_second, only_third, dry_run, confirm, appointment_id=appointment_id, attempt=attempt)
+                except SlotUnavailable as e:
+                    log('  ├╴ Appointment not available anymore :( %s', e)
+
+                if not booked:
+                    self.release_appointment(appointment_id)
+
+            return booked
+
+    @traced('book_slot')
+    def book_slot(self, profile_id, motive_id, practice_id, agenda_ids, vac_name, slot_date_first, slot_date_second, only_second, only_third, dry_run=False, confirm=False, appointment_id=None, attempt=None):
+        self.tracer.annotate(motive_id=motive_id, practice_id=practice_id, slot=slot_date_first)
+        if attempt is None:
+            attempt = BookingAttempt()
+        try:
+            return self._book_slot(attempt, profile_id, motive_id, practice_id, agenda_ids, vac_name, slot_date_first, slot_date_second,
+                                   only_second, only_third, dry_run, confirm, appointment_id)
+        except SlotUnavailable:
+            attempt.outcome = 'unavailable'
+            raise
+        finally:
+            self.booking_latency.record(attempt)
+
+    def _book_slot(self, attempt, profile_id, motive_id, practice_id, agenda_ids, vac_name, slot_date_first, slot_date_second, only_second, only_third, dry_run, confirm, appointment_id):
+        booking_data = self.prepare_booking()
+
+        data = self.get_appointment_data(profile_id, motive_id, practice_id, agenda_ids, slot_date_first)
+
+        # the slot may already be held
+        if appointment_id is None:
+            with attempt.step('appointment'):
+                self.appointment.go(data=json.dumps(data), headers=self.JSON_HEADERS)
+
+            if self.page.is_error():
+                raise SlotUnavailable(self.page.get_error())
+
+            appointment_id = self.page.doc['id']
+
+        self.notifier.notify('slot_held', 'Slot held for %s %s on %s' % (
+            self.patient['first_name'], self.patient['last_name'], parse_iso_datetime(slot_date_first).strftime('%c')))
 
         if vac_name != "janssen" and not only_second and not only_third:  # janssen has only one shot
-            self.second_shot_availabilities.go(
-                params={'start_date': slot_date_second.split('T')[0],
-                        'visit_motive_ids': motive_id,
-                        'agenda_ids': '-'.join(agenda_ids),
-                        'first_slot': slot_date_first,
-                        'insurance_sector': 'public',
-                        'practice_ids': practice_id,
-                        'limit': 3})
-
-            second_slot = self.page.find_best_slot()
-            if not second_slot:
-                log('  └╴ No second shot found')
-                return False
+            second_slot_held = False
+            if self.trust_second_slot and slot_date_second:
+                # the second shot date given with the first one is usually
+                # still free, so save a lookup and only do it when rejected
+                log('  ├╴ Second shot: %s', parse_iso_datetime(
+                    slot_date_second).strftime('%c'))
+
+                data['second_slot'] = slot_date_second
+                with attempt.step('appointment'):
+                    self.appointment.go(data=json.dumps(data), headers=self.JSON_HEADERS)
+
+                second_slot_held = not self.page.is_error()
+                if second_slot_held:
+                    appointment_id = self.page.doc['id']
+                else:
+                    log('  ├╴ Second shot not available anymore :( %s', self.page.get_error())
+
+            if not second_slot_held:
+                with attempt.step('second_shot_availabilities'):
+                    self.second_shot_availabilities.go(
+                        params={'start_date': slot_date_second.split('T')[0],
+                                'visit_motive_ids': motive_id,
+                                'agenda_ids': '-'.join(agenda_ids),
+                                'first_slot': slot_date_first,
+                                'insurance_sector': 'public',
+                                'practice_ids': practice_id,
+                                'limit': 3})
+
+                second_slot = self.find_second_slot(self.page, slot_date_first)
+                if not second_slot:
+                    log('  └╴ No second shot found')
+                    attempt.outcome = 'no_second_shot'
+                    return False
 
-            # in theory we could use the stored slot_date_second result from above,
-            # but we refresh with the new results to play safe
-            if isinstance(second_slot, dict) and 'start_date' in second_slot:
-                slot_date_second = second_slot['start_date']
-            elif isinstance(slot, str):
-                slot_date_second = second_slot
-            # TODO: is this else needed?
-            # elif isinstance(slot, list):
-            #    slot_date_second = second_slot[1]
-            else:
-                log('Error while fetching second slot.', color='red')
-                return False
+                # in theory we could use the stored slot_date_second result from above,
+                # but we refresh with the new results to play safe
+                slot_date_second = second_slot.first
 
-            log('  ├╴ Second shot: %s', parse_date(
-                slot_date_second).strftime('%c'))
+                log('  ├╴ Second shot: %s', parse_iso_datetime(
+                    slot_date_second).strftime('%c'))
 
-            data['second_slot'] = slot_date_second
-            self.appointment.go(data=json.dumps(data), headers=headers)
+                data['second_slot'] = slot_date_second
+                with attempt.step('appointment'):
+                    self.appointment.go(data=json.dumps(data), headers=self.JSON_HEADERS)
 
-            if self.page.is_error():
-                log('  └╴ Appointment not available anymore :( %s',
-                    self.page.get_error())
-                return False
+                if self.page.is_error():
+                    raise SlotUnavailable(self.page.get_error())
 
-        a_id = self.page.doc['id']
+                appointment_id = self.page.doc['id']
 
-        self.appointment_edit.go(id=a_id)
+        a_id = appointment_id
 
-        log('  ├╴ Booking for %(first_name)s %(last_name)s...' % self.patient)
+        with attempt.step('appointment_edit'):
+            self.appointment_edit.go(id=a_id)
 
-        self.appointment_edit.go(
-            id=a_id, params={'master_patient_id': self.patient['id']})
+            log('  ├╴ Booking for %(first_name)s %(last_name)s...' % self.patient)
+
+            self.appointment_edit.go(
+                id=a_id, params={'master_patient_id': self.patient['id']})
 
         custom_fields = {}
         for field in self.page.get_custom_fields():
@@ -538,48 +1788,54 @@ class Doctolib(LoginBrowser, StatesMixin):
                 value = 'Non'
             elif field['placeholder']:
                 value = field['placeholder']
+            elif self.custom_field_answers.get(self.patient['id'], field) is not None:
+                value = self.custom_field_answers.get(self.patient['id'], field)
+                log('  ├╴ %s: %s (stored answer)', field['label'], value)
             else:
                 for key, value in field.get('options', []):
                     print('  │  %s %s' % (colored(key, 'green'), colored(value, 'yellow')))
                 print('  ├╴ %s%s:' % (field['label'], (' (%s)' % field['placeholder']) if field['placeholder'] else ''),
                       end=' ', flush=True)
-                value = sys.stdin.readline().strip()
+                with attempt.step('prompt'):
+                    value = sys.stdin.readline().strip()
+                self.custom_field_answers.set(self.patient['id'], field, value)
 
             custom_fields[field['id']] = value
 
         if dry_run:
-            log('  └╴ Booking status: %s', 'fake')
+            log('  └╴ Booking status: %s (%s)', 'fake', '%.2fs' % (time() - attempt.seen_at))
+            attempt.outcome = 'fake'
             return True
 
         if confirm:
             print('  ├╴ Do you want to book it? (y/N)', end=' ', flush=True)
-            if sys.stdin.readline().strip().lower() != 'y':
+            with attempt.step('prompt'):
+                answer = sys.stdin.readline().strip().lower()
+            if answer != 'y':
                 log('  └╴ Skipped')
+                attempt.outcome = 'skipped'
                 return False
 
-        data = {'appointment': {'custom_fields_values': custom_fields,
-                                'new_patient': True,
-                                'qualification_answers': {},
-                                'referrer_id': None,
-                                },
-                'bypass_mandatory_relative_contact_info': False,
-                'email': None,
-                'master_patient': self.patient,
-                'new_patient': True,
-                'patient': None,
-                'phone_number': None,
-                }
-
-        self.appointment_post.go(id=a_id, data=json.dumps(
-            data), headers=headers, method='PUT')
+        data = dict(booking_data,
+                    appointment=dict(booking_data['appointment'], custom_fields_values=custom_fields))
+
+        with attempt.step('appointment_post'):
+            self.appointment_post.go(id=a_id, data=json.dumps(
+                data), headers=self.JSON_HEADERS, method='PUT')
 
         if 'redirection' in self.page.doc and not 'confirmed-appointment' in self.page.doc['redirection']:
             log('  ├╴ Open %s to complete', self.BASEURL +
                 self.page.doc['redirection'])
 
-        self.appointment_post.go(id=a_id)
+        with attempt.step('appointment_confirm'):
+            self.appointment_post.go(id=a_id)
 
-        log('  └╴ Booking status: %s', self.page.doc['confirmed'])
+        attempt.outcome = 'confirmed' if self.page.doc['confirmed'] else 'not_confirmed'
+        log('  └╴ Booking status: %s (%s)', self.page.doc['confirmed'], '%.2fs' % (time() - attempt.seen_at))
+
+        if self.page.doc['confirmed']:
+            self.notifier.notify('booked', 'Appointment booked for %s %s on %s' % (
+                self.patient['first_name'], self.patient['last_name'], parse_iso_datetime(slot_date_first).strftime('%c')))
 
         return self.page.doc['confirmed']
 
@@ -606,6 +1862,7 @@ class DoctolibDE(Doctolib):
         KEY_ASTRAZENECA: 'AstraZeneca',
         KEY_ASTRAZENECA_SECOND: 'Zweit.*AstraZeneca|AstraZeneca.*Zweit',
     }
+    motive_matcher = MotiveMatcher(vaccine_motives.values())
     centers = URL(r'/impfung-covid-19-corona/(?P<where>\w+)', CentersPage)
     center = URL(r'/praxis/.*', CenterPage)
 
@@ -632,6 +1889,7 @@ class DoctolibFR(Doctolib):
         KEY_ASTRAZENECA: 'AstraZeneca',
         KEY_ASTRAZENECA_SECOND: '2de.*AstraZeneca',
     }
+    motive_matcher = MotiveMatcher(vaccine_motives.values())
 
     centers = URL(r'/vaccination-covid-19/(?P<where>\w+)', CentersPage)
     center = URL(r'/centre-de-sante/.*', CenterPage)
@@ -640,6 +1898,8 @@ class DoctolibFR(Doctolib):
 class Application:
     DATA_DIRNAME = (Path(os.environ.get("XDG_DATA_HOME") or Path.home() / ".local" / "share")) / 'doctoshotgun'
     STATE_FILENAME = DATA_DIRNAME / 'state.json'
+    SEARCH_RESULTS_FILENAME = DATA_DIRNAME / 'search_results.json'
+    CUSTOM_FIELDS_FILENAME = DATA_DIRNAME / 'custom_fields.json'
 
     @classmethod
     def create_default_logger(cls):
@@ -671,6 +1931,110 @@ class Application:
         with open(self.STATE_FILENAME, 'w') as fp:
             json.dump(state, fp)
 
+    def filter_centers(self, docto, cities, motives, args):
+        for center in docto.find_centers(cities, motives):
+            if not args.include_neighbor_city and not docto.normalize(center['city']).startswith(tuple(cities)):
+                logging.debug("Skipping city '%(city)s' %(name_with_title)s" % center)
+                continue
+            if args.center:
+                if center['name_with_title'] not in args.center:
+                    logging.debug("Skipping center '%s'" %
+                                  center['name_with_title'])
+                    continue
+            if args.zipcode:
+                center_matched = False
+                for zipcode in args.zipcode:
+                    if center['zipcode'] == zipcode:
+                        center_matched = True
+                if not center_matched:
+                    logging.debug("Skipping center '%(name_with_title)s' ['%(zipcode)s']" % center)
+                    continue
+            if args.center_regex:
+                center_matched = False
+                for center_regex in args.center_regex:
+                    if re.match(center_regex, center['name_with_title']):
+                        center_matched = True
+                    else:
+                        logging.debug(
+                            "Skipping center '%(name_with_title)s'" % center)
+                if not center_matched:
+                    continue
+            if args.center_exclude:
+                if center['name_with_title'] in args.center_exclude:
+                    logging.debug(
+                        "Skipping center '%(name_with_title)s' because it's excluded" % center)
+                    continue
+            if args.center_exclude_regex:
+                center_excluded = False
+                for center_exclude_regex in args.center_exclude_regex:
+                    if re.match(center_exclude_regex, center['name_with_title']):
+                        logging.debug(
+                            "Skipping center '%(name_with_title)s' because it's excluded" % center)
+                        center_excluded = True
+                if center_excluded:
+                    continue
+
+            yield center
+
+    def book_best_slot(self, docto, executor, centers, probe_center, vaccine_list, start_date, end_date, excluded_weekdays, args):
+        """
+        Probe all centers of a round at the same time, then try to book
+        their slots from the best scored one.
+        """
+        probes = [(center, executor.submit(probe_center, center)) for center in centers]
+
+        candidates = []
+        for center, future in probes:
+            try:
+                probe = future.result()
+            except (ClientError, ServerError) as e:
+                log('Center %s: %s', center['name_with_title'], e, color='red')
+                continue
+
+            try:
+                for score, candidate in docto.find_candidates(center, probe, vaccine_list, start_date, end_date, excluded_weekdays,
+                                                              args.only_second, args.only_third):
+                    # the counter keeps candidates with the same score in order, without comparing them
+                    heapq.heappush(candidates, (score, len(candidates), candidate))
+            finally:
+                probe.cancel()
+
+        log('%s matching slots found in %s centers', len(candidates), len(probes))
+
+        if docto.speculative_holds > 1 and candidates:
+            best = [heapq.heappop(candidates)[2] for i in range(min(len(candidates), docto.speculative_holds))]
+            for candidate in best:
+                log('– %s, %s: %s', candidate['center']['name_with_title'], candidate['vac_name'],
+                    parse_iso_datetime(candidate['slot'].first).strftime('%c'))
+            return docto.book_speculatively(best, args.only_second, args.only_third, args.dry_run, args.confirm)
+
+        # (center, motive, practice) -> number of slots tried, None once the place failed
+        attempts = {}
+        while candidates:
+            score, _, candidate = heapq.heappop(candidates)
+            place_key = (candidate['center']['url'], candidate['motive_id'], candidate['practice_id'])
+            tried = attempts.get(place_key, 0)
+            if tried is None or tried >= docto.MAX_SLOT_ATTEMPTS:
+                continue
+            attempts[place_key] = tried + 1
+
+            log('')
+            log('Center %(name_with_title)s (%(city)s):' % candidate['center'])
+            if candidate['place']['name']:
+                log('– %s...', candidate['place']['name'])
+            log('  Vaccine %s: %s', candidate['vac_name'], parse_iso_datetime(candidate['slot'].first).strftime('%c'))
+
+            try:
+                if docto.book_candidate(candidate, args.only_second, args.only_third, args.dry_run, args.confirm):
+                    return True
+            except SlotUnavailable as e:
+                log('  ├╴ Appointment not available anymore :( %s', e)
+            else:
+                # not a race with someone else, other slots of this place would fail the same way
+                attempts[place_key] = None
+
+        return False
+
     def main(self, cli_args=None):
         colorama.init()  # needed for windows
 
@@ -717,10 +2081,57 @@ class Application:
                             help='last date on which you want to book the first slot (format should be DD/MM/YYYY)')
         parser.add_argument('--weekday-exclude', '-w', nargs='*', type=str, default=[], action='append',
                             help='Exclude specific weekdays, e.g. "tuesday Wednesday FRIDAY"')
+        parser.add_argument('--slot-policy', choices=('latest', 'earliest'), default='latest',
+                            help='on the earliest day with slots, prefer the latest or the earliest time (default = latest)')
+        parser.add_argument('--preferred-hours', type=str, default=None,
+                            help='prefer slots between these hours, e.g. "8-12"')
+        parser.add_argument('--time-of-day', type=str, default=None,
+                            help='only book slots between these times, e.g. "08:00-12:30"')
+        parser.add_argument('--min-dose-gap', type=int, default=None,
+                            help='minimum number of days between the two shots')
+        parser.add_argument('--max-dose-gap', type=int, default=None,
+                            help='maximum number of days between the two shots')
+        parser.add_argument('--trust-second-slot', action='store_true',
+                            help='book the second shot proposed with the first one, without looking it up again')
+        parser.add_argument('--custom-fields', type=str, default=None,
+                            help='file storing answers of each patient to appointment questions (default = %s)' % self.CUSTOM_FIELDS_FILENAME)
+        parser.add_argument('--hold-slots', type=int, default=1,
+                            help='number of best slots held at the same time, the first one held being booked, '
+                                 'other ones are released but may stay held until they expire (default = 1, max = %s)' % Doctolib.MAX_SPECULATIVE_HOLDS)
         parser.add_argument('--dry-run', action='store_true',
                             help='do not really book the slot')
         parser.add_argument('--confirm', action='store_true',
                             help='prompt to confirm before booking')
+        parser.add_argument('--no-sound', action='store_true',
+                            help='do not play a sound when a slot is held')
+        parser.add_argument('--notify-desktop', action='store_true',
+                            help='show desktop notifications (requires notify-send)')
+        parser.add_argument('--notify-file', type=str, default=None,
+                            help='append notifications to this file')
+        parser.add_argument('--notify-webhook', type=str, default=None,
+                            help='POST notifications as JSON to this URL')
+        parser.add_argument('--workers', type=int, default=Doctolib.MAX_WORKERS,
+                            help='number of requests sent to Doctolib at the same time (default = %s)' % Doctolib.MAX_WORKERS)
+        parser.add_argument('--parallel-centers', type=int, default=4,
+                            help='number of next centers looked up in background (default = 4)')
+        parser.add_argument('--best-slot', action='store_true',
+                            help='look up all centers before booking the best slot among them')
+        parser.add_argument('--search-cache-ttl', type=int, default=3600,
+                            help='how many seconds centers found by search are kept in cache (default = 3600, 0 to disable)')
+        parser.add_argument('--booking-cache-ttl', type=int, default=600,
+                            help='how many seconds booking profiles of centers are kept in cache (default = 600, 0 to disable)')
+        parser.add_argument('--persist-cache', action='store_true',
+                            help='keep cache between runs')
+        parser.add_argument('--metrics-json', type=str, default=None,
+                            help='periodically write request metrics by endpoint to this JSON file')
+        parser.add_argument('--metrics-prometheus', type=str, default=None,
+                            help='periodically write request metrics by endpoint to this file in Prometheus text format')
+        parser.add_argument('--metrics-interval', type=int, default=60,
+                            help='how many seconds between two exports of metrics (default = 60)')
+        parser.add_argument('--base-url', type=str, default=None,
+                            help='URL of the Doctolib website, e.g. of a local fake_doctolib.py server')
+        parser.add_argument('--trace', type=str, default=None,
+                            help='write traces of rounds, centers and bookings to this JSONL file')
         parser.add_argument(
             'country', help='country where to book', choices=list(doctolib_map.keys()))
         parser.add_argument('city', help='city where to book')
@@ -739,13 +2150,66 @@ class Application:
         if not args.password:
             args.password = getpass.getpass()
 
+        preferred_hours = None
+        if args.preferred_hours:
+            m = re.match(r'^(\d+)-(\d+)$', args.preferred_hours)
+            if not m:
+                print('Invalid value for --preferred-hours: %s' % args.preferred_hours)
+                return 1
+            preferred_hours = (int(m.group(1)), int(m.group(2)))
+
+        time_of_day = None
+        if args.time_of_day:
+            m = re.match(r'^(\d+):(\d+)-(\d+):(\d+)$', args.time_of_day)
+            if not m:
+                print('Invalid value for --time-of-day: %s' % args.time_of_day)
+                return 1
+            time_of_day = (int(m.group(1)) * 60 + int(m.group(2)), int(m.group(3)) * 60 + int(m.group(4)))
+
+        sinks = []
+        if not args.no_sound:
+            sinks.append(SoundSink())
+        if args.notify_desktop:
+            sinks.append(DesktopSink())
+        if args.notify_file:
+            sinks.append(FileSink(args.notify_file))
+        if args.notify_webhook:
+            sinks.append(WebhookSink(args.notify_webhook))
+        notifier = Notifier(sinks)
+
+        search_results = DocumentCache(args.search_cache_ttl,
+                                       filename=self.SEARCH_RESULTS_FILENAME if args.persist_cache else None)
+        search_results.load()
+
+        tracer = Tracer(args.trace)
+        booking_latency = BookingLatency()
+
+        metrics = None
+        if args.metrics_json or args.metrics_prometheus:
+            metrics = RequestMetrics()
+            metrics.start_export(args.metrics_json, args.metrics_prometheus, args.metrics_interval)
+
+        custom_field_answers = CustomFieldAnswers(args.custom_fields or self.CUSTOM_FIELDS_FILENAME)
+        custom_field_answers.load()
+
         docto = doctolib_map[args.country](
-            args.username, args.password, responses_dirname=responses_dirname)
+            args.username, args.password, responses_dirname=responses_dirname, max_workers=args.workers,
+            search_results=search_results, booking_profiles=DocumentCache(args.booking_cache_ttl),
+            slot_policy=args.slot_policy, preferred_hours=preferred_hours,
+            time_of_day=time_of_day, dose_gap=(args.min_dose_gap, args.max_dose_gap),
+            trust_second_slot=args.trust_second_slot, speculative_holds=args.hold_slots,
+            custom_field_answers=custom_field_answers, notifier=notifier, metrics=metrics,
+            tracer=tracer, booking_latency=booking_latency)
+        if args.base_url:
+            docto.BASEURL = args.base_url.rstrip('/')
         docto.load_state(self.load_state())
 
+        executor = ThreadPoolExecutor(max_workers=max(args.parallel_centers, 1))
+
         try:
-            if not docto.do_login(args.code):
-                return 1
+            with tracer.span('login'):
+                if not docto.do_login(args.code):
+                    return 1
 
             patients = docto.get_patients()
             if len(patients) == 0:
@@ -860,64 +2324,46 @@ class Application:
             log('This may take a few minutes/hours, be patient!')
             cities = [docto.normalize(city) for city in args.city.split(',')]
 
+            def probe_center(center):
+                return docto.probe_center(center, vaccine_list, start_date, end_date, args.only_second, args.only_third,
+                                          excluded_weekdays)
+
+            rounds = itertools.count(1)
             while True:
                 log_ts()
                 try:
-                    for center in docto.find_centers(cities, motives):
-                        if not args.include_neighbor_city and not docto.normalize(center['city']).startswith(tuple(cities)):
-                            logging.debug("Skipping city '%(city)s' %(name_with_title)s" % center)
-                            continue
-                        if args.center:
-                            if center['name_with_title'] not in args.center:
-                                logging.debug("Skipping center '%s'" %
-                                              center['name_with_title'])
-                                continue
-                        if args.zipcode:
-                            center_matched = False
-                            for zipcode in args.zipcode:
-                                if center['zipcode'] == zipcode:
-                                    center_matched = True
-                            if not center_matched:
-                                logging.debug("Skipping center '%(name_with_title)s' ['%(zipcode)s']" % center)
-                                continue
-                        if args.center_regex:
-                            center_matched = False
-                            for center_regex in args.center_regex:
-                                if re.match(center_regex, center['name_with_title']):
-                                    center_matched = True
-                                else:
-                                    logging.debug(
-                                        "Skipping center '%(name_with_title)s'" % center)
-                            if not center_matched:
-                                continue
-                        if args.center_exclude:
-                            if center['name_with_title'] in args.center_exclude:
-                                logging.debug(
-                                    "Skipping center '%(name_with_title)s' because it's excluded" % center)
-                                continue
-                        if args.center_exclude_regex:
-                            center_excluded = False
-                            for center_exclude_regex in args.center_exclude_regex:
-                                if re.match(center_exclude_regex, center['name_with_title']):
-                                    logging.debug(
-                                        "Skipping center '%(name_with_title)s' because it's excluded" % center)
-                                    center_excluded = True
-                            if center_excluded:
-                                continue
-
-                        log('')
-
-                        log('Center %(name_with_title)s (%(city)s):' % center)
-
-                        if docto.try_to_book(center, vaccine_list, start_date, end_date, excluded_weekdays, args.only_second, args.only_third, args.dry_run, args.confirm):
+                    with tracer.span('round', number=next(rounds)):
+                        # centers probed in background belong to this round
+                        round_probe_center = tracer.bind(probe_center)
+                        centers = self.filter_centers(docto, cities, motives, args)
+                        if args.best_slot:
+                            if self.book_best_slot(docto, executor, centers, round_probe_center, vaccine_list, start_date, end_date,
+                                                   excluded_weekdays, args):
+                                log('')
+                                log('💉 %s Congratulations.' %
+                                    colored('Booked!', 'green', attrs=('bold',)))
+                                return 0
+                            # all centers have already been tried
+                            centers = ()
+                        elif args.parallel_centers > 0:
+                            centers = prefetch(executor, centers, round_probe_center, args.parallel_centers)
+                        else:
+                            centers = ((center, None) for center in centers)
+
+                        for center, probe in centers:
                             log('')
-                            log('💉 %s Congratulations.' %
-                                colored('Booked!', 'green', attrs=('bold',)))
-                            return 0
 
-                        sleep(SLEEP_INTERVAL_AFTER_CENTER)
+                            log('Center %(name_with_title)s (%(city)s):' % center)
+
+                            if docto.try_to_book(center, vaccine_list, start_date, end_date, excluded_weekdays, args.only_second, args.only_third, args.dry_run, args.confirm, probe=probe):
+                                log('')
+                                log('💉 %s Congratulations.' %
+                                    colored('Booked!', 'green', attrs=('bold',)))
+                                return 0
 
-                        log('')
+                            sleep(SLEEP_INTERVAL_AFTER_CENTER)
+
+                            log('')
                     log('No free slots found at selected centers. Trying another round in %s sec...', SLEEP_INTERVAL_AFTER_RUN)
                     sleep(SLEEP_INTERVAL_AFTER_RUN)
                 except CityNotFound as e:
@@ -941,7 +2387,15 @@ class Application:
                     return 1
             return 0
         finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            notifier.close()
+            booking_latency.report()
             self.save_state(docto.dump_state())
+            search_results.save()
+            custom_field_answers.save()
+            if metrics is not None:
+                metrics.stop()
+            tracer.close()
 
 
 if __name__ == '__main__':
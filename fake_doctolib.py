@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+"""
+Local stand-in of Doctolib, to run doctoshotgun end to end without network.
+
+It serves the endpoints used by doctoshotgun, with data seeded from
+test_fixtures, and can simulate latency, errors, deep pagination and slots
+taken by other people.
+
+    ./fake_doctolib.py --port 8000 --pages 5 --latency 0.05 --churn 0.2
+    ./doctoshotgun.py de koeln user@example.com secret --base-url http://127.0.0.1:8000 --dry-run
+"""
+import argparse
+import base64
+import datetime
+import json
+import os
+import random
+import re
+import threading
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qs, urlsplit
+
+FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_fixtures')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_FOLDER, name)) as fp:
+        return json.load(fp)
+
+
+class FakeDoctolib:
+    """
+    State of the fake Doctolib: centers, free slots and appointments.
+
+    Slots of a (practice, motive, day) are generated from the seed, so they
+    do not need to be stored, and only taken ones are remembered.
+    """
+
+    SEARCH_PREFIXES = {'/impfung-covid-19-corona/': '/praxis/',
+                       '/vaccination-covid-19/': '/centre-de-sante/',
+                       }
+
+    def __init__(self, seed=0, pages=3, centers_per_page=10, latency=0.0, jitter=0.0, errors=None,
+                 churn=0.0, density=0.5, slots_per_day=6, horizon=60, today=None):
+        self.seed = seed
+        self.pages = pages
+        self.centers_per_page = centers_per_page
+        self.latency = latency
+        self.jitter = jitter
+        # status code -> probability
+        self.errors = errors or {}
+        # probability that a slot returned by a lookup is then taken by someone else
+        self.churn = churn
+        self.density = density
+        self.slots_per_day = slots_per_day
+        self.horizon = horizon
+        self.today = today or datetime.date.today()
+
+        self.doctor = load_fixture('doctor_response.json')
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.taken = set()
+        self.appointments = {}
+        # search result id -> center
+        self.centers = {}
+
+    def random(self):
+        with self.lock:
+            return self.rng.random()
+
+    def wait(self):
+        delay = self.latency + (self.random() * self.jitter if self.jitter else 0)
+        if delay > 0:
+            sleep(delay)
+
+    def pick_error(self, statuses):
+        for status in statuses:
+            if self.errors.get(status, 0) > self.random():
+                return status
+        return None
+
+    # Search
+
+    def get_center(self, center_id, prefix='/praxis/', city='koeln'):
+        with self.lock:
+            center = self.centers.get(center_id)
+            if center is None:
+                center = self.centers[center_id] = {
+                    'id': center_id,
+                    'name_with_title': 'Impfzentrum %s' % center_id,
+                    'city': city,
+                    'zipcode': '%05d' % (center_id % 100000),
+                    'distance': center_id % 50,
+                    'url': '%s%s/center-%s' % (prefix, city, center_id),
+                }
+            return center
+
+    def search_page(self, prefix, city, page):
+        city_id = zlib.crc32(city.encode()) % 10000
+        ids = [(city_id * 1000 + (page - 1) * self.centers_per_page + i) for i in range(self.centers_per_page)]
+        for center_id in ids:
+            self.get_center(center_id, self.SEARCH_PREFIXES[prefix], city)
+
+        results = ''.join('<div class="js-dl-search-results-calendar" data-props="%s"></div>\n'
+                          % json.dumps({'searchResultId': center_id}).replace('"', '&quot;') for center_id in ids)
+
+        next_link = ''
+        if page < self.pages:
+            href = '%s%s?page=%s' % (prefix, city, page + 1)
+            if prefix == '/vaccination-covid-19/':
+                # the French website hides the link in a reversed base64 attribute
+                data_u = base64.urlsafe_b64encode(href.encode()).decode()[::-1]
+                next_link = '<div class="next"><span data-u="%s">Suivant</span></div>' % data_u
+            else:
+                next_link = '<div class="next"><a href="%s">Nächste Seite</a></div>' % href
+
+        return '<html><body>\n%s<div class="next-previous-links">%s</div></body></html>' % (results, next_link)
+
+    def get_booking(self, center_id):
+        doc = json.loads(json.dumps(self.doctor))
+        data = doc['data']
+        data['profile']['id'] = center_id
+        practice_id = self.get_practice_id(center_id)
+        data['places'] = [{'name': 'Impfzentrum %s' % center_id, 'practice_ids': [practice_id]}]
+        data['agendas'] = [{'id': center_id,
+                            'booking_disabled': False,
+                            'practice_id': practice_id,
+                            'visit_motive_ids': [m['id'] for m in data['visit_motives']],
+                            }]
+        return doc
+
+    @staticmethod
+    def get_practice_id(center_id):
+        return 100000 + center_id
+
+    # Availabilities
+
+    def get_motive(self, motive_id):
+        for motive in self.doctor['data']['visit_motives']:
+            if str(motive['id']) == str(motive_id):
+                return motive
+        return None
+
+    def generate_slots(self, practice_id, motive_id, date):
+        if not self.today <= date < self.today + datetime.timedelta(days=self.horizon):
+            return []
+
+        rng = random.Random('%s-%s-%s-%s' % (self.seed, practice_id, motive_id, date))
+        if rng.random() >= self.density:
+            return []
+
+        minutes = sorted(rng.sample(range(8 * 60, 18 * 60, 10), self.slots_per_day))
+        return ['%sT%02d:%02d:00.000+02:00' % (date, minute // 60, minute % 60) for minute in minutes]
+
+    def free_slots(self, practice_id, motive_id, date):
+        with self.lock:
+            return [slot for slot in self.generate_slots(practice_id, motive_id, date)
+                    if (practice_id, slot) not in self.taken]
+
+    def format_slot(self, slot, motive):
+        if not motive or not motive['vaccination_days_range']:
+            return slot
+        second = parse_slot(slot) + datetime.timedelta(days=motive['vaccination_days_range'])
+        return {'start_date': slot, 'steps': [{'start_date': slot}, {'start_date': format_slot_date(second)}]}
+
+    def availabilities(self, params, second_shot=False):
+        start_date = datetime.date.fromisoformat(params['start_date'])
+        limit = int(params.get('limit', 3))
+        motive_id = params['visit_motive_ids']
+        practice_id = int(params['practice_ids'])
+        motive = None if second_shot else self.get_motive(motive_id)
+
+        days = []
+        seen = []
+        for i in range(limit):
+            date = start_date + datetime.timedelta(days=i)
+            slots = self.free_slots(practice_id, motive_id, date)
+            seen += slots
+            days.append({'date': date.isoformat(), 'slots': [self.format_slot(slot, motive) for slot in slots]})
+
+        doc = {'availabilities': days, 'total': len(seen)}
+        if not seen:
+            for i in range(limit, self.horizon):
+                date = start_date + datetime.timedelta(days=i)
+                if self.free_slots(practice_id, motive_id, date):
+                    doc['next_slot'] = date.isoformat()
+                    break
+
+        # someone else books one of the slots just seen
+        if seen and self.churn > self.random():
+            with self.lock:
+                self.taken.add((practice_id, self.rng.choice(seen)))
+
+        return doc
+
+    # Appointments
+
+    def hold(self, data):
+        appointment = data['appointment']
+        practice_id = int(data['practice_ids'][0])
+        slot = appointment['start_date']
+        motive_id = appointment['visit_motive_ids']
+
+        with self.lock:
+            held = [a for a in self.appointments.values()
+                    if a['practice_id'] == practice_id and a['slot'] == slot]
+            if 'second_slot' in data and held:
+                # the second shot is added to the same appointment
+                held[0]['second_slot'] = data['second_slot']
+                return {'id': held[0]['id']}
+
+        date = parse_slot(slot).date()
+        with self.lock:
+            if slot not in self.generate_slots(practice_id, motive_id, date) or (practice_id, slot) in self.taken:
+                return {'error': 'Ce créneau n\'est plus disponible'}
+            self.taken.add((practice_id, slot))
+            appointment_id = str(uuid.UUID(int=self.rng.getrandbits(128)))
+            self.appointments[appointment_id] = {'id': appointment_id,
+                                                 'practice_id': practice_id,
+                                                 'slot': slot,
+                                                 'confirmed': False,
+                                                 }
+        return {'id': appointment_id}
+
+    def release(self, appointment_id):
+        with self.lock:
+            appointment = self.appointments.pop(appointment_id, None)
+            if appointment is None:
+                return False
+            self.taken.discard((appointment['practice_id'], appointment['slot']))
+            return True
+
+    def confirm(self, appointment_id):
+        with self.lock:
+            appointment = self.appointments.get(appointment_id)
+            if appointment is None:
+                return False
+            appointment['confirmed'] = True
+            return True
+
+    def is_confirmed(self, appointment_id):
+        with self.lock:
+            appointment = self.appointments.get(appointment_id)
+            return bool(appointment and appointment['confirmed'])
+
+
+def parse_slot(slot):
+    return datetime.datetime.fromisoformat(slot.replace('.000', ''))
+
+
+def format_slot_date(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%S.000') + date.strftime('%z')[:3] + ':' + date.strftime('%z')[3:]
+
+
+class FakeDoctolibHandler(BaseHTTPRequestHandler):
+    # set by make_server()
+    doctolib = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type='application/json'):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', '%s; charset=utf-8' % content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def handle_request(self, method):
+        url = urlsplit(self.path)
+        path = url.path
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        doctolib = self.doctolib
+
+        doctolib.wait()
+
+        if method == 'GET' and path == '/sessions/new':
+            return self.send(200, '<html></html>', 'text/html')
+        if method == 'POST' and path == '/login.json':
+            self.read_json()
+            return self.send(200, {'redirection': '/account'})
+        if method == 'POST' and path in ('/api/accounts/send_auth_code', '/login/challenge'):
+            self.read_json()
+            return self.send(200, '')
+        if method == 'GET' and path == '/account/master_patients.json':
+            return self.send(200, [{'id': 1, 'first_name': 'Roger', 'last_name': 'Phillibert'}])
+
+        status = doctolib.pick_error((503, 520))
+        if status:
+            return self.send(status, '<html>Error %s</html>' % status, 'text/html')
+
+        for prefix in doctolib.SEARCH_PREFIXES:
+            m = re.match(r'^%s([\w-]+)$' % re.escape(prefix), path)
+            if method == 'GET' and m:
+                return self.send(200, doctolib.search_page(prefix, m.group(1), int(params.get('page', 1))), 'text/html')
+
+        m = re.match(r'^/search_results/(\d+)\.json$', path)
+        if method == 'GET' and m:
+            center = doctolib.get_center(int(m.group(1)))
+            return self.send(200, {'search_result': center})
+
+        m = re.match(r'^(/praxis/|/centre-de-sante/).*/center-(\d+)$', path)
+        if method == 'GET' and m:
+            if doctolib.pick_error((410,)):
+                return self.send(410, '<html>Gone</html>', 'text/html')
+            return self.send(200, '<html>%s</html>' % m.group(2), 'text/html')
+
+        m = re.match(r'^/booking/center-(\d+)\.json$', path)
+        if method == 'GET' and m:
+            return self.send(200, doctolib.get_booking(int(m.group(1))))
+
+        if method == 'GET' and path == '/availabilities.json':
+            return self.send(200, doctolib.availabilities(params))
+        if method == 'GET' and path == '/second_shot_availabilities.json':
+            return self.send(200, doctolib.availabilities(params, second_shot=True))
+
+        if method == 'POST' and path == '/appointments.json':
+            return self.send(200, doctolib.hold(self.read_json()))
+
+        m = re.match(r'^/appointments/([\w-]+)/edit\.json$', path)
+        if method == 'GET' and m:
+            return self.send(200, {'id': m.group(1), 'appointment': {'custom_fields': []}})
+
+        m = re.match(r'^/appointments/([\w-]+)\.json$', path)
+        if m:
+            appointment_id = m.group(1)
+            if method == 'PUT':
+                self.read_json()
+                if doctolib.confirm(appointment_id):
+                    return self.send(200, {'id': appointment_id})
+                return self.send(404, {'error': 'Not found'})
+            if method == 'GET':
+                return self.send(200, {'id': appointment_id, 'confirmed': doctolib.is_confirmed(appointment_id)})
+            # guessed endpoint, as released by doctoshotgun
+            if method == 'DELETE':
+                if doctolib.release(appointment_id):
+                    return self.send(200, {})
+                return self.send(404, {'error': 'Not found'})
+
+        return self.send(404, '<html>Not found</html>', 'text/html')
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+def make_server(doctolib, host='127.0.0.1', port=8000):
+    handler = type('Handler', (FakeDoctolibHandler,), {'doctolib': doctolib})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(cli_args=None):
+    parser = argparse.ArgumentParser(description='Local stand-in of Doctolib')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default = 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default = 8000)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of generated slots (default = 0)')
+    parser.add_argument('--pages', type=int, default=3, help='number of search pages by city (default = 3)')
+    parser.add_argument('--centers-per-page', type=int, default=10, help='number of centers by search page (default = 10)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response (default = 0)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='maximum random seconds added to latency (default = 0)')
+    parser.add_argument('--error-503', type=float, default=0.0, help='probability of 503 responses (default = 0)')
+    parser.add_argument('--error-520', type=float, default=0.0, help='probability of 520 responses (default = 0)')
+    parser.add_argument('--error-410', type=float, default=0.0, help='probability of 410 responses for centers (default = 0)')
+    parser.add_argument('--churn', type=float, default=0.0,
+                        help='probability that a slot returned by a lookup is then taken by someone else (default = 0)')
+    parser.add_argument('--density', type=float, default=0.5, help='probability that a day has slots (default = 0.5)')
+    parser.add_argument('--horizon', type=int, default=60, help='number of days with slots (default = 60)')
+    args = parser.parse_args(cli_args)
+
+    doctolib = FakeDoctolib(seed=args.seed, pages=args.pages, centers_per_page=args.centers_per_page,
+                            latency=args.latency, jitter=args.jitter,
+                            errors={503: args.error_503, 520: args.error_520, 410: args.error_410},
+                            churn=args.churn, density=args.density, horizon=args.horizon)
+    server = make_server(doctolib, args.host, args.port)
+    print('Fake Doctolib listening on http://%s:%s' % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
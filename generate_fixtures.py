@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Generate large fixtures shaped like Doctolib responses, from a seed:
+
+- pages of search results, with their next links in the French (data-u) or
+  German (href) format;
+- booking profiles with many motives, agendas and places;
+- windows of availabilities, with slots in the three formats returned by
+  Doctolib.
+
+    ./generate_fixtures.py /tmp/fixtures --seed 1 --pages 20 --motives 500
+"""
+import argparse
+import base64
+import datetime
+import json
+import os
+import random
+from html import escape
+
+SEARCH_PREFIXES = {'fr': '/vaccination-covid-19/',
+                   'de': '/impfung-covid-19-corona/',
+                   }
+
+# name, days between shots
+VACCINES = (('BioNTech-Pfizer', 21), ('Moderna', 28), ('AstraZeneca', 63), ('Janssen', 0))
+MOTIVE_FORMATS = {'fr': ('1re injection vaccin COVID-19 (%s)', '2de injection vaccin COVID-19 (%s)', '3e injection vaccin COVID-19 (%s)'),
+                  'de': ('Erstimpfung Covid-19 (%s)', 'Zweitimpfung Covid-19 (%s)', 'Auffrischungsimpfung Covid-19 (%s)'),
+                  }
+OTHER_MOTIVES = ('Consultation générale', 'Grippe saisonnière', 'Allgemeine Sprechstunde', 'Reiseimpfung')
+SLOT_SHAPES = ('dict', 'str', 'list')
+
+
+def encode_data_u(href):
+    # reversed base64, split on several lines like the French website does
+    data_u = base64.urlsafe_b64encode(href.encode()).decode()[::-1]
+    return '\n'.join(data_u[i:i + 60] for i in range(0, len(data_u), 60))
+
+
+def centers_pages(seed=0, pages=3, centers_per_page=10, city='paris', country='fr'):
+    """
+    Return the HTML of each page of search results of a city.
+    """
+    rng = random.Random('%s-centers-%s' % (seed, city))
+    prefix = SEARCH_PREFIXES[country]
+    result = []
+    for page in range(1, pages + 1):
+        cards = []
+        for i in range(centers_per_page):
+            center_id = rng.randrange(1000000, 10000000)
+            props = {'searchResultId': center_id,
+                     'practiceIds': [rng.randrange(100000, 1000000)],
+                     'visitMotiveIds': sorted(rng.sample(range(6000, 10000), 3)),
+                     'isTelehealth': False,
+                     }
+            cards.append('<div class="dl-search-result" id="search-result-%s">\n'
+                         '  <div class="dl-search-result-presentation">\n'
+                         '    <h3 class="dl-search-result-name">Centre de vaccination %s</h3>\n'
+                         '    <div class="dl-text">%s rue de la Paix, %s</div>\n'
+                         '  </div>\n'
+                         "  <div class='js-dl-search-results-calendar' data-props='%s'></div>\n"
+                         '</div>' % (center_id, center_id, rng.randrange(1, 200), city,
+                                     escape(json.dumps(props, separators=(',', ':')))))
+
+        if page < pages:
+            href = '%s%s?page=%s&ref_visit_motive_ids%%5B%%5D=6970&ref_visit_motive_ids%%5B%%5D=7005' % (prefix, city, page + 1)
+            if country == 'fr':
+                next_link = '<span data-u="%s">Suivant</span>' % encode_data_u(href)
+            else:
+                next_link = '<a href="%s">Nächste Seite</a>' % escape(href)
+        else:
+            next_link = '<span class="disabled">Suivant</span>'
+
+        result.append('<html><body>\n<div class="dl-search-results">\n%s\n</div>\n'
+                      '<div class="next-previous-links">\n'
+                      '  <div class="previous dl-rounded-borders dl-white-bg"><span class="disabled">Précédent</span></div>\n'
+                      '  <div class="next dl-rounded-borders dl-white-bg">%s</div>\n'
+                      '</div>\n</body></html>' % ('\n'.join(cards), next_link))
+    return result
+
+
+def booking_profile(seed=0, motives=300, agendas=200, places=50, country='de'):
+    """
+    Return a booking profile with the given numbers of motives, agendas and places.
+    """
+    rng = random.Random('%s-booking' % seed)
+    formats = MOTIVE_FORMATS[country]
+
+    visit_motives = []
+    for i in range(motives):
+        motive_id = 2000000 + i
+        if rng.random() < 0.2:
+            visit_motives.append({'id': motive_id,
+                                  'name': rng.choice(OTHER_MOTIVES),
+                                  'vaccination_days_range': 0,
+                                  'first_shot_motive': False,
+                                  'allow_new_patients': True,
+                                  })
+            continue
+
+        vaccine, days_range = rng.choice(VACCINES)
+        dose = 0 if vaccine == 'Janssen' else rng.randrange(len(formats))
+        visit_motives.append({'id': motive_id,
+                              'name': formats[dose] % vaccine,
+                              'vaccination_days_range': days_range if dose == 0 else 0,
+                              'first_shot_motive': dose == 0 and vaccine != 'Janssen',
+                              'allow_new_patients': rng.random() < 0.9,
+                              })
+
+    place_list = [{'name': 'Impfzentrum %s - Halle %s' % (seed, i),
+                   'address': '%s Hauptstraße' % rng.randrange(1, 200),
+                   'practice_ids': [300000 + i],
+                   } for i in range(places)]
+
+    agenda_list = []
+    motive_ids = [m['id'] for m in visit_motives]
+    for i in range(agendas):
+        agenda_list.append({'id': 400000 + i,
+                            'booking_disabled': rng.random() < 0.1,
+                            'practice_id': place_list[i % places]['practice_ids'][0] if places else None,
+                            'visit_motive_ids': sorted(rng.sample(motive_ids, min(len(motive_ids), rng.randrange(1, 6)))),
+                            })
+
+    return {'data': {'profile': {'id': rng.randrange(1000000, 10000000)},
+                     'visit_motives': visit_motives,
+                     'agendas': agenda_list,
+                     'places': place_list,
+                     }}
+
+
+def format_slot(start, days_range, shape):
+    first = start.strftime('%Y-%m-%dT%H:%M:00.000+02:00')
+    second = (start + datetime.timedelta(days=days_range)).strftime('%Y-%m-%dT%H:%M:00.000+02:00')
+    if shape == 'str':
+        return first
+    if shape == 'list':
+        return [first, second] if days_range else [first]
+    return {'start_date': first,
+            'steps': [{'start_date': first}, {'start_date': second}] if days_range else [{'start_date': first}],
+            }
+
+
+def availabilities_windows(seed=0, start_date=datetime.date(2021, 6, 1), windows=10, limit=3,
+                           density=0.3, slots_per_day=20, days_range=21, shape='mixed'):
+    """
+    Return consecutive windows of availabilities, of limit days each.
+
+    With the 'mixed' shape, each day uses one of the three slot formats.
+    Empty windows give the next day with slots, as Doctolib does.
+    """
+    rng = random.Random('%s-availabilities' % seed)
+    days = []
+    for i in range(windows * limit):
+        date = start_date + datetime.timedelta(days=i)
+        slots = []
+        if rng.random() < density:
+            day_shape = rng.choice(SLOT_SHAPES) if shape == 'mixed' else shape
+            minutes = sorted(rng.sample(range(7 * 60, 20 * 60, 5), min(slots_per_day, 13 * 12)))
+            start = datetime.datetime.combine(date, datetime.time())
+            slots = [format_slot(start + datetime.timedelta(minutes=minute), days_range, day_shape) for minute in minutes]
+        days.append({'date': date.isoformat(), 'slots': slots})
+
+    result = []
+    for i in range(windows):
+        window = days[i * limit:(i + 1) * limit]
+        doc = {'availabilities': window, 'total': sum(len(day['slots']) for day in window)}
+        if not doc['total']:
+            later = [day['date'] for day in days[(i + 1) * limit:] if day['slots']]
+            if later:
+                doc['next_slot'] = later[0]
+        result.append(doc)
+    return result
+
+
+def main(cli_args=None):
+    parser = argparse.ArgumentParser(description='Generate large fixtures shaped like Doctolib responses')
+    parser.add_argument('output', help='directory where fixtures are written')
+    parser.add_argument('--seed', type=int, default=0, help='seed of generated data (default = 0)')
+    parser.add_argument('--country', choices=list(SEARCH_PREFIXES), default='fr', help='format of pages (default = fr)')
+    parser.add_argument('--pages', type=int, default=10, help='number of search pages (default = 10)')
+    parser.add_argument('--centers-per-page', type=int, default=20, help='number of centers by search page (default = 20)')
+    parser.add_argument('--motives', type=int, default=300, help='number of motives of the booking profile (default = 300)')
+    parser.add_argument('--agendas', type=int, default=200, help='number of agendas of the booking profile (default = 200)')
+    parser.add_argument('--places', type=int, default=50, help='number of places of the booking profile (default = 50)')
+    parser.add_argument('--windows', type=int, default=20, help='number of availabilities windows (default = 20)')
+    parser.add_argument('--slots-per-day', type=int, default=20, help='number of slots of days with slots (default = 20)')
+    parser.add_argument('--shape', choices=SLOT_SHAPES + ('mixed',), default='mixed',
+                        help='format of slots (default = mixed)')
+    args = parser.parse_args(cli_args)
+
+    os.makedirs(args.output, exist_ok=True)
+    for page, html in enumerate(centers_pages(args.seed, args.pages, args.centers_per_page, country=args.country), 1):
+        with open(os.path.join(args.output, 'centers_page_%s.html' % page), 'w') as fp:
+            fp.write(html)
+
+    with open(os.path.join(args.output, 'booking.json'), 'w') as fp:
+        json.dump(booking_profile(args.seed, args.motives, args.agendas, args.places, args.country), fp, indent=1)
+
+    for window, doc in enumerate(availabilities_windows(args.seed, windows=args.windows, slots_per_day=args.slots_per_day,
+                                                        shape=args.shape), 1):
+        with open(os.path.join(args.output, 'availabilities_%s.json' % window), 'w') as fp:
+            json.dump(doc, fp, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
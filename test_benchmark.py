@@ -0,0 +1,28 @@
+from benchmark import BENCHMARKS, compare_results
+
+
+def test_benchmarks_should_run_on_scaled_inputs():
+    """
+    Check that each benchmark finds what it looks for in its synthetic inputs
+    """
+    benchmarks = dict((name, setup(10)) for name, setup in BENCHMARKS)
+
+    assert len(benchmarks['iter_centers_ids']()) == 10
+    assert benchmarks['get_next_page']() == 2
+    assert benchmarks['find_motives']() == {'AstraZeneca': 2000001, 'Janssen': 2000009}
+    assert benchmarks['get_agenda_ids']() == ['400002', '400006', '400009']
+    assert benchmarks['find_best_slot']().first == '2021-06-01T19:25:00.000+02:00'
+    assert len(benchmarks['normalize']()) == 10
+
+
+def test_compare_results_should_flag_regressions():
+    """
+    Check that only benchmarks slower than the threshold are flagged
+    """
+    baseline = {'normalize[10]': 1.0, 'find_motives[10]': 1.0, 'get_next_page[10]': 1.0}
+    current = {'normalize[10]': 1.1, 'find_motives[10]': 1.5}
+
+    assert compare_results(baseline, current, threshold=0.2) == [
+        ('normalize[10]', 1.0, 1.1, 1.1, False),
+        ('find_motives[10]', 1.0, 1.5, 1.5, True),
+    ]
@@ -1,13 +1,18 @@
 import pytest
 from requests.adapters import Response
 import responses
+from responses import matchers
 from html import escape
 import lxml.html as html
 import json
 import datetime
 from woob.browser.browsers import Browser
 from woob.browser.exceptions import ServerError
-from doctoshotgun import CentersPage, DoctolibDE, DoctolibFR, CenterBookingPage
+import threading
+import argparse
+from unittest.mock import MagicMock
+from concurrent.futures import ThreadPoolExecutor
+from doctoshotgun import Application, AvailabilitiesPage, CentersPage, DoctolibDE, DoctolibFR, BookingLatency, CenterBookingPage, BookingGate, CustomFieldAnswers, DocumentCache, FileSink, MotiveMatcher, Notifier, RequestMetrics, Tracer, Slot, SlotConstraints, prefetch
 
 # globals
 FIXTURES_FOLDER = "test_fixtures"
@@ -608,9 +613,9 @@ def test_book_slots_should_succeed(tmp_path):
 
 
 @responses.activate
-def test_find_motive_should_ignore_second_shot(tmp_path):
+def test_find_motives_should_ignore_second_shot(tmp_path):
     """
-    Check that find_motive ignores second shot motives
+    Check that find_motives ignores second shot motives
     """
 
     with open(FIXTURES_FOLDER + '/doctor_response.json') as json_file:
@@ -621,10 +626,1001 @@ def test_find_motive_should_ignore_second_shot(tmp_path):
 
     booking_page = CenterBookingPage(browser=Browser(), response=response)
     booking_page.doc = mock_doctor_response
-    visit_motive_id = CenterBookingPage.find_motive(
-        booking_page, '.*(Pfizer)', False)
-    assert visit_motive_id == mock_doctor_response['data']['visit_motives'][1]['id']
+    matcher = MotiveMatcher(['.*(Pfizer)', '.*(Janssen)'])
+    motives_id = booking_page.find_motives(matcher, ['.*(Pfizer)'])
+    assert motives_id == {'.*(Pfizer)': mock_doctor_response['data']['visit_motives'][1]['id']}
 
-    visit_motive_id = CenterBookingPage.find_motive(
-        booking_page, '.*(Janssen)', True)
-    assert visit_motive_id == mock_doctor_response['data']['visit_motives'][3]['id']
+    motives_id = booking_page.find_motives(matcher, ['.*(Janssen)'], ['.*(Janssen)'])
+    assert motives_id == {'.*(Janssen)': mock_doctor_response['data']['visit_motives'][3]['id']}
+
+
+@responses.activate
+def test_find_centers_should_yield_centers_in_page_order(tmp_path):
+    """
+    Check that centers fetched concurrently are yielded in the order of the search page
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path, max_workers=4)
+    docto.BASEURL = "https://127.0.0.1"
+
+    center_ids = [1234567, 1234568, 1234569]
+    responses.add(
+        responses.GET,
+        SEARCH_URL_FOR_MUNCHEN,
+        status=200,
+        body="".join(
+            "<div class='js-dl-search-results-calendar' data-props='{dataProps}'></div>".format(
+                dataProps=escape(json.dumps({"searchResultId": i}, separators=(',', ':'))))
+            for i in center_ids)
+    )
+
+    for i in center_ids:
+        responses.add(
+            responses.GET,
+            "https://127.0.0.1/search_results/%s.json" % i,
+            status=200,
+            body=json.dumps({"search_result": {"id": i}})
+        )
+
+    centers = list(docto.find_centers(["München"]))
+    assert [center['id'] for center in centers] == center_ids
+
+
+def test_prefetch_should_keep_order_and_run_ahead():
+    """
+    Check that prefetch yields items in order while computing the next ones in background
+    """
+    submitted = []
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        def submit(self, fn, item):
+            submitted.append(item)
+            return super().submit(fn, item)
+
+    with RecordingExecutor(max_workers=2) as executor:
+        results = prefetch(executor, range(5), lambda item: item * 2, 2)
+
+        item, future = next(results)
+        assert (item, future.result()) == (0, 0)
+        # the next two items are already being computed
+        assert submitted == [0, 1, 2]
+
+        assert [(item, future.result()) for item, future in results] == [(1, 2), (2, 4), (3, 6), (4, 8)]
+
+
+@responses.activate
+def test_find_centers_should_paginate_each_city_on_its_own(tmp_path):
+    """
+    Check that find_centers walks the pages of each city only once
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path)
+    docto.BASEURL = "https://127.0.0.1"
+
+    def search_page(center_id, next_page=None):
+        body = "<div class='js-dl-search-results-calendar' data-props='{dataProps}'></div>".format(
+            dataProps=escape(json.dumps({"searchResultId": center_id}, separators=(',', ':'))))
+        if next_page:
+            body += "<div class='next'><a href='/impfung-covid-19-corona/munchen?page={}'>Next</a></div>".format(next_page)
+        return body
+
+    search_url_for_berlin = SEARCH_URL_FOR_MUNCHEN.replace('M%C3%BCnchen', 'Berlin')
+    responses.add(responses.GET, SEARCH_URL_FOR_MUNCHEN,
+                  status=200, body=search_page(1, next_page=2))
+    responses.add(responses.GET, SEARCH_URL_FOR_MUNCHEN.replace('page=1', 'page=2'),
+                  status=200, body=search_page(2))
+    responses.add(responses.GET, search_url_for_berlin,
+                  status=200, body=search_page(3))
+
+    for i in range(1, 4):
+        responses.add(
+            responses.GET,
+            "https://127.0.0.1/search_results/%s.json" % i,
+            status=200,
+            body=json.dumps({"search_result": {"id": i}})
+        )
+
+    centers = list(docto.find_centers(["München", "Berlin"]))
+    assert [center['id'] for center in centers] == [1, 2, 3]
+    assert len(responses.calls) == 6
+
+
+@responses.activate
+def test_find_centers_should_fetch_next_page_before_yielding_centers(tmp_path):
+    """
+    Check that the next search page is already requested when the first center is processed
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path, max_workers=1)
+    docto.BASEURL = "https://127.0.0.1"
+
+    search_url_page_2 = SEARCH_URL_FOR_MUNCHEN.replace('page=1', 'page=2')
+    responses.add(
+        responses.GET,
+        SEARCH_URL_FOR_MUNCHEN,
+        status=200,
+        body="<div class='js-dl-search-results-calendar' data-props='{dataProps}'></div>"
+             "<div class='next'><a href='/impfung-covid-19-corona/munchen?page=2'>Next</a></div>".format(
+                 dataProps=escape(json.dumps({"searchResultId": 1}, separators=(',', ':'))))
+    )
+    responses.add(responses.GET, search_url_page_2, status=200, body="<div></div>")
+    responses.add(
+        responses.GET,
+        "https://127.0.0.1/search_results/1.json",
+        status=200,
+        body=json.dumps({"search_result": {"id": 1}})
+    )
+
+    centers = docto.find_centers(["München"])
+    assert next(centers) == {"id": 1}
+    assert [call.request.url for call in responses.calls][:2] == [SEARCH_URL_FOR_MUNCHEN, search_url_page_2]
+    assert list(centers) == []
+
+
+@responses.activate
+def test_find_centers_should_not_fetch_cached_centers_again(tmp_path):
+    """
+    Check that search results in cache are not requested on the next round
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path,
+                       search_results=DocumentCache(ttl=60))
+    docto.BASEURL = "https://127.0.0.1"
+
+    responses.add(
+        responses.GET,
+        SEARCH_URL_FOR_MUNCHEN,
+        status=200,
+        body="<div class='js-dl-search-results-calendar' data-props='{dataProps}'></div>".format(
+            dataProps=escape(json.dumps({"searchResultId": 1}, separators=(',', ':'))))
+    )
+    responses.add(
+        responses.GET,
+        "https://127.0.0.1/search_results/1.json",
+        status=200,
+        body=json.dumps({"search_result": {"id": 1}})
+    )
+
+    assert list(docto.find_centers(["München"])) == [{"id": 1}]
+    assert len(responses.calls) == 2
+    assert list(docto.find_centers(["München"])) == [{"id": 1}]
+    assert len(responses.calls) == 3
+
+
+def test_document_cache_should_expire_evict_and_persist(tmp_path, monkeypatch):
+    """
+    Check that DocumentCache drops expired and least recently used entries, and can be saved
+    """
+    now = [1000.0]
+    monkeypatch.setattr('doctoshotgun.time', lambda: now[0])
+
+    cache = DocumentCache(ttl=60, max_size=2, filename=str(tmp_path / 'cache' / 'cache.json'))
+    cache.set(1, {"id": 1})
+    cache.set(2, {"id": 2})
+    assert cache.get(1) == {"id": 1}
+    cache.set(3, {"id": 3})
+    assert cache.get(2) is None
+    assert cache.get(1) == {"id": 1}
+
+    cache.save()
+    loaded = DocumentCache(ttl=60, filename=cache.filename)
+    loaded.load()
+    assert loaded.get(3) == {"id": 3}
+
+    now[0] += 60
+    assert loaded.get(3) is None
+    assert DocumentCache(ttl=0).get(1) is None
+
+
+@responses.activate
+def test_probe_center_should_use_cached_booking_profile(tmp_path):
+    """
+    Check that the booking profile of a center is not requested again while it is in cache
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path,
+                       booking_profiles=DocumentCache(ttl=60))
+    docto.BASEURL = "https://127.0.0.1"
+
+    with open(FIXTURES_FOLDER + '/doctor_response.json') as json_file:
+        mock_doctor_response = json.load(json_file)
+    with open(FIXTURES_FOLDER + '/availabilities.json') as json_file:
+        mock_availabilities = json.load(json_file)
+
+    responses.add(responses.GET, "https://127.0.0.1/allgemeinmedizin/koeln/dr-dre",
+                  status=200, body=json.dumps(mock_doctor_response))
+    responses.add(responses.GET, "https://127.0.0.1/booking/dr-dre.json",
+                  status=200, body=json.dumps(mock_doctor_response))
+    responses.add(responses.GET, "https://127.0.0.1/availabilities.json",
+                  status=200, body=json.dumps(mock_availabilities))
+
+    center = {"url": "/allgemeinmedizin/koeln/dr-dre"}
+    for _ in range(2):
+        probe = docto.probe_center(center, ["Janssen"], datetime.date(2021, 6, 1), datetime.date(2021, 6, 14),
+                                   only_second=False, only_third=False)
+        assert list(probe.availabilities.keys()) == [(2920448, 234567)]
+        probe.availabilities[(2920448, 234567)].result()
+
+    assert [call.request.url.split('?')[0] for call in responses.calls] == [
+        "https://127.0.0.1/allgemeinmedizin/koeln/dr-dre",
+        "https://127.0.0.1/booking/dr-dre.json",
+        "https://127.0.0.1/availabilities.json",
+        "https://127.0.0.1/availabilities.json",
+    ]
+
+
+def test_get_agenda_ids_should_filter_on_practice(tmp_path):
+    """
+    Check that get_agenda_ids only returns enabled agendas of the motive and practice
+    """
+    response = Response()
+    response._content = b'{}'
+
+    booking_page = CenterBookingPage(browser=Browser(), response=response)
+    booking_page.doc = {"data": {"agendas": [
+        {"id": 1, "practice_id": 10, "booking_disabled": False, "visit_motive_ids": [100, 101]},
+        {"id": 2, "practice_id": 20, "booking_disabled": False, "visit_motive_ids": [100]},
+        {"id": 3, "practice_id": 10, "booking_disabled": True, "visit_motive_ids": [100]},
+    ]}}
+
+    assert booking_page.get_agenda_ids(100, 10) == ['1']
+    assert booking_page.get_agenda_ids(100) == ['1', '2']
+    assert booking_page.get_agenda_ids(101, 20) == []
+
+
+def test_motive_matcher_should_match_all_vaccines_at_once(tmp_path):
+    """
+    Check that MotiveMatcher finds the motives of all vaccines at once
+    """
+    with open(FIXTURES_FOLDER + '/doctor_response.json') as json_file:
+        mock_doctor_response = json.load(json_file)
+    visit_motives = mock_doctor_response['data']['visit_motives']
+
+    motives_id, messages = DoctolibDE.motive_matcher.match(
+        visit_motives, ['Janssen', 'Zweit.*Pfizer|Pfizer.*Zweit', 'Pfizer', 'Moderna'],
+        single_shot_vaccines=['Janssen'])
+    assert motives_id == {
+        'Janssen': visit_motives[3]['id'],
+        'Pfizer': visit_motives[1]['id'],
+    }
+    assert list(motives_id.keys()) == ['Janssen', 'Pfizer']
+    assert messages == [('Skipping second shot motive %s...', visit_motives[2]['name'])]
+
+    motives_id, messages = MotiveMatcher(['AstraZeneca']).match(visit_motives, ['astrazeneca'])
+    assert motives_id == {'astrazeneca': visit_motives[0]['id']}
+
+
+def test_booking_gate_should_keep_temporary_appointments_while_booking():
+    """
+    Check that a booking waits for destroying lookups, and that lookups started meanwhile do not destroy
+    """
+    gate = BookingGate()
+    booking_started = threading.Event()
+
+    with gate.lookup() as destroy_temporary:
+        assert destroy_temporary
+
+        def book():
+            with gate.book():
+                booking_started.set()
+
+        thread = threading.Thread(target=book)
+        thread.start()
+        # the booking can not start while this lookup is in progress
+        assert not booking_started.wait(0.1)
+
+        with gate.lookup() as destroy_temporary:
+            assert not destroy_temporary
+
+    thread.join()
+    assert booking_started.is_set()
+
+    with gate.lookup() as destroy_temporary:
+        assert destroy_temporary
+
+
+@responses.activate
+def test_find_availabilities_should_stop_at_end_date(tmp_path):
+    """
+    Check that find_availabilities jumps to the window of next_slot, but not beyond end_date
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path)
+    docto.BASEURL = "https://127.0.0.1"
+
+    assert docto.get_availabilities_windows(datetime.date(2021, 6, 1), datetime.date(2021, 6, 7)) == [
+        datetime.date(2021, 6, 1), datetime.date(2021, 6, 4), datetime.date(2021, 6, 7)]
+
+    def availabilities_url(start_date, motive_id):
+        return ("https://127.0.0.1/availabilities.json?start_date=%s&visit_motive_ids=%s&agenda_ids=1"
+                "&insurance_sector=public&practice_ids=234567&destroy_temporary=true&limit=3" % (start_date, motive_id))
+
+    with open(FIXTURES_FOLDER + '/availabilities.json') as json_file:
+        mock_availabilities = json.load(json_file)
+
+    responses.add(responses.GET, availabilities_url('2021-06-01', 1), status=200,
+                  body=json.dumps({"availabilities": [], "next_slot": "2021-06-10"}))
+    responses.add(responses.GET, availabilities_url('2021-06-10', 1), status=200,
+                  body=json.dumps(mock_availabilities))
+    responses.add(responses.GET, availabilities_url('2021-06-01', 2), status=200,
+                  body=json.dumps({"availabilities": [], "next_slot": "2021-06-20"}))
+
+    page = docto.find_availabilities(1, 234567, ['1'], datetime.date(2021, 6, 1), datetime.date(2021, 6, 14))
+    assert page.doc == mock_availabilities
+    assert len(responses.calls) == 2
+
+    page = docto.find_availabilities(2, 234567, ['1'], datetime.date(2021, 6, 1), datetime.date(2021, 6, 14))
+    assert page.doc['next_slot'] == "2021-06-20"
+    assert len(responses.calls) == 3
+
+
+@responses.activate
+def test_find_availabilities_should_merge_windows(tmp_path):
+    """
+    Check that find_availabilities keeps the availabilities of all windows it fetched
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path)
+    docto.BASEURL = "https://127.0.0.1"
+
+    def availabilities_url(start_date):
+        return ("https://127.0.0.1/availabilities.json?start_date=%s&visit_motive_ids=1&agenda_ids=1"
+                "&insurance_sector=public&practice_ids=234567&destroy_temporary=true&limit=3" % start_date)
+
+    with open(FIXTURES_FOLDER + '/availabilities.json') as json_file:
+        mock_availabilities = json.load(json_file)
+
+    responses.add(responses.GET, availabilities_url('2021-06-01'), status=200,
+                  body=json.dumps({"availabilities": [{"date": "2021-06-02", "slots": []},
+                                                      {"date": "2021-06-20", "slots": ["2021-06-20T08:00:00.000+02:00"]}]}))
+    responses.add(responses.GET, availabilities_url('2021-06-04'), status=200,
+                  body=json.dumps(mock_availabilities))
+
+    page = docto.find_availabilities(1, 234567, ['1'], datetime.date(2021, 6, 1), datetime.date(2021, 6, 14))
+    assert len(responses.calls) == 2
+    assert [a['date'] for a in page.doc['availabilities']] == ['2021-06-02', '2021-06-10', '2021-06-20']
+    assert page.find_best_slot(datetime.date(2021, 6, 1), datetime.date(2021, 6, 14)).first == \
+        mock_availabilities['availabilities'][0]['slots'][-1]['start_date']
+
+
+@responses.activate
+def test_find_availabilities_should_stop_on_empty_window(tmp_path):
+    """
+    Check that find_availabilities does not fetch later windows when there is no slot and no next_slot
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path)
+    docto.BASEURL = "https://127.0.0.1"
+
+    responses.add(responses.GET, "https://127.0.0.1/availabilities.json", status=200,
+                  body=json.dumps({"availabilities": [{"date": "2021-06-01", "slots": []},
+                                                      {"date": "2021-06-02", "slots": []},
+                                                      {"date": "2021-06-03", "slots": []}],
+                                   "total": 0}))
+
+    page = docto.find_availabilities(1, 234567, ['1'], datetime.date(2021, 6, 1), datetime.date(2021, 7, 31))
+    assert len(responses.calls) == 1
+    assert page.find_best_slot() is None
+
+
+def test_slot_should_normalize_all_formats():
+    """
+    Check that slots are parsed the same way whatever their format
+    """
+    first, second = "2021-06-10T08:30:00.000+02:00", "2021-07-20T08:30:00.000+02:00"
+
+    for doc in ({"start_date": first, "steps": [{}, {"start_date": second}]}, [first, second]):
+        slot = Slot.from_doc(doc)
+        assert (slot.first, slot.second) == (first, second)
+        assert slot.date == datetime.date(2021, 6, 10)
+        assert slot.minute == 8 * 60 + 30
+        assert slot.second_timestamp - slot.timestamp == 40 * 24 * 3600
+
+    slot = Slot.from_doc(first)
+    assert (slot.first, slot.second, slot.second_timestamp) == (first, None, None)
+
+    # not supported by fromisoformat before python 3.11
+    assert Slot.from_doc("2021-06-10T06:30:00Z").timestamp == slot.timestamp
+    assert Slot.from_doc({}) is None
+
+
+def test_iter_slots_should_rank_slots_by_policy(tmp_path):
+    """
+    Check that iter_slots yields slots in the order of the selected policy
+    """
+    response = Response()
+    response._content = b'{}'
+
+    page = AvailabilitiesPage(browser=Browser(), response=response)
+    page.doc = {"availabilities": [
+        {"date": "2021-06-10", "slots": ["2021-06-10T08:00:00.000+02:00", "2021-06-10T14:00:00.000+02:00"]},
+        {"date": "2021-06-11", "slots": ["2021-06-11T10:00:00.000+02:00"]},
+    ]}
+
+    def hours(slots):
+        return [slot.first[8:13] for slot in slots]
+
+    assert hours(page.iter_slots()) == ['10T14', '10T08', '11T10']
+    assert hours(page.iter_slots(policy='earliest')) == ['10T08', '10T14', '11T10']
+    assert hours(page.iter_slots(preferred_hours=(9, 12))) == ['11T10', '10T14', '10T08']
+    assert page.find_best_slot().first == "2021-06-10T14:00:00.000+02:00"
+
+
+@responses.activate
+def test_try_to_book_place_should_try_next_slot_when_taken(tmp_path):
+    """
+    Check that when a slot is booked by someone else, the next one is tried without fetching availabilities again
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path)
+    docto.BASEURL = "https://127.0.0.1"
+    docto.patient = {"id": "patient-id", "first_name": "Roger", "last_name": "Phillibert"}
+
+    with open(FIXTURES_FOLDER + '/availabilities.json') as json_file:
+        mock_availabilities = json.load(json_file)
+    responses.add(responses.GET, "https://127.0.0.1/availabilities.json",
+                  status=200, body=json.dumps(mock_availabilities))
+
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=200, body=json.dumps({"error": "Appointment not available anymore"}))
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=200, body=json.dumps({"id": "appointment-id"}))
+    responses.add(responses.GET, "https://127.0.0.1/appointments/appointment-id/edit.json",
+                  status=200, body=json.dumps({"appointment": {"custom_fields": {}}}))
+
+    assert docto.try_to_book_place(1234, 2920448, 234567, [], "janssen",
+                                   datetime.date(2021, 6, 1), datetime.date(2021, 6, 14), [],
+                                   only_second=False, only_third=False, dry_run=True)
+
+    appointments = [json.loads(call.request.body)['appointment']['start_date']
+                    for call in responses.calls if call.request.method == 'POST']
+    assert appointments == ["2021-06-10T08:40:00.000+02:00", "2021-06-10T08:30:00.000+02:00"]
+    assert len([call for call in responses.calls if 'availabilities' in call.request.url]) == 1
+
+
+def test_slot_constraints_should_filter_slots(tmp_path):
+    """
+    Check that SlotConstraints applies date, weekday, time of day and dose gap constraints
+    """
+    days = [
+        (datetime.date(2021, 6, 10), [
+            Slot("2021-06-10T08:00:00.000+02:00", "2021-07-01T08:00:00.000+02:00"),
+            Slot("2021-06-10T14:00:00.000+02:00", "2021-07-20T14:00:00.000+02:00"),
+        ]),
+        # a friday
+        (datetime.date(2021, 6, 11), [Slot("2021-06-11T10:00:00.000+02:00", "2021-07-20T10:00:00.000+02:00")]),
+        (datetime.date(2021, 6, 20), [Slot("2021-06-20T10:00:00.000+02:00")]),
+    ]
+
+    def hours(constraints):
+        return [slot.first[8:13] for slot in constraints.filter(days)]
+
+    assert hours(SlotConstraints()) == ['10T08', '10T14', '11T10', '20T10']
+    assert hours(SlotConstraints(end_date=datetime.date(2021, 6, 14), excluded_weekdays=[4])) == ['10T08', '10T14']
+    assert hours(SlotConstraints(time_of_day=(9 * 60, 14 * 60))) == ['10T14', '11T10', '20T10']
+    assert hours(SlotConstraints(min_dose_gap=25)) == ['10T14', '11T10', '20T10']
+    assert hours(SlotConstraints(max_dose_gap=25)) == ['10T08', '20T10']
+
+
+@responses.activate
+def test_find_candidates_should_score_slots_of_all_centers(tmp_path):
+    """
+    Check that slots of several centers are scored by day, distance and time in the day
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path)
+    docto.BASEURL = "https://127.0.0.1"
+
+    with open(FIXTURES_FOLDER + '/doctor_response.json') as json_file:
+        mock_doctor_response = json.load(json_file)
+    with open(FIXTURES_FOLDER + '/availabilities.json') as json_file:
+        mock_availabilities = json.load(json_file)
+
+    responses.add(responses.GET, "https://127.0.0.1/allgemeinmedizin/koeln/dr-dre",
+                  status=200, body=json.dumps(mock_doctor_response))
+    responses.add(responses.GET, "https://127.0.0.1/booking/dr-dre.json",
+                  status=200, body=json.dumps(mock_doctor_response))
+    responses.add(responses.GET, "https://127.0.0.1/availabilities.json",
+                  status=200, body=json.dumps(mock_availabilities))
+
+    far = {"url": "/allgemeinmedizin/koeln/dr-dre", "distance": 12.5}
+    near = {"url": "/allgemeinmedizin/koeln/dr-dre", "distance": "3.2"}
+    candidates = []
+    for center in (far, near):
+        probe = docto.probe_center(center, ["Janssen"], datetime.date(2021, 6, 1), datetime.date(2021, 6, 14),
+                                   only_second=False, only_third=False)
+        candidates += docto.find_candidates(center, probe, ["Janssen"], datetime.date(2021, 6, 1), datetime.date(2021, 6, 14),
+                                            [], only_second=False, only_third=False)
+
+    best = [(candidate['center'], candidate['slot'].first[11:16]) for _, candidate in sorted(candidates, key=lambda c: c[0])]
+    assert best == [(near, "08:40"), (near, "08:30"), (far, "08:40"), (far, "08:30")]
+    assert all(candidate['motive_id'] == 2920448 and candidate['practice_id'] == 234567 for _, candidate in candidates)
+
+
+@responses.activate
+def test_try_to_book_should_skip_places_on_server_error(tmp_path):
+    """
+    Check that a server error while looking up availabilities skips the place instead of aborting
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path)
+    docto.BASEURL = "https://127.0.0.1"
+
+    with open(FIXTURES_FOLDER + '/doctor_response.json') as json_file:
+        mock_doctor_response = json.load(json_file)
+
+    responses.add(responses.GET, "https://127.0.0.1/allgemeinmedizin/koeln/dr-dre",
+                  status=200, body=json.dumps(mock_doctor_response))
+    responses.add(responses.GET, "https://127.0.0.1/booking/dr-dre.json",
+                  status=200, body=json.dumps(mock_doctor_response))
+    responses.add(responses.GET, "https://127.0.0.1/availabilities.json",
+                  status=503, body="<html>Error 503</html>", content_type="text/html")
+
+    center = {"url": "/allgemeinmedizin/koeln/dr-dre", "name_with_title": "Dr Dre"}
+    assert not docto.try_to_book(center, ["Janssen"], datetime.date(2021, 6, 1), datetime.date(2021, 6, 14), [],
+                                 only_second=False, only_third=False)
+    probe = docto.probe_center(center, ["Janssen"], datetime.date(2021, 6, 1), datetime.date(2021, 6, 14),
+                               only_second=False, only_third=False)
+    assert docto.find_candidates(center, probe, ["Janssen"], datetime.date(2021, 6, 1), datetime.date(2021, 6, 14),
+                                 [], only_second=False, only_third=False) == []
+
+
+def test_book_best_slot_should_skip_places_which_failed(tmp_path, monkeypatch):
+    """
+    Check that once a place fails for another reason than a race, its other slots are not tried
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path)
+    best = {"name_with_title": "Best", "city": "koeln", "url": "/allgemeinmedizin/koeln/best"}
+    other = {"name_with_title": "Other", "city": "koeln", "url": "/allgemeinmedizin/koeln/other"}
+
+    def find_candidates(center, probe, *args):
+        hours = ("19", "18", "17", "16", "15", "14") if center is best else ("08",)
+        return [(docto.score_slot(slot), {'center': center, 'place': {'name': ''}, 'vac_name': 'Pfizer',
+                                          'motive_id': 1, 'practice_id': 2, 'slot': slot})
+                for slot in (Slot("2021-06-10T%s:00:00.000+02:00" % hour, "2021-07-10T%s:00:00.000+02:00" % hour)
+                             for hour in hours)]
+
+    booked = []
+
+    def book_candidate(candidate, *args):
+        booked.append(candidate['center']['name_with_title'])
+        # no second shot at the best center
+        return candidate['center'] is other
+
+    monkeypatch.setattr(docto, 'find_candidates', find_candidates)
+    monkeypatch.setattr(docto, 'book_candidate', book_candidate)
+    args = argparse.Namespace(only_second=False, only_third=False, dry_run=True, confirm=False)
+    with ThreadPoolExecutor() as executor:
+        assert Application().book_best_slot(docto, executor, [best, other], lambda center: MagicMock(), ['Pfizer'],
+                                            datetime.date(2021, 6, 1), datetime.date(2021, 6, 14), [], args)
+    assert booked == ["Best", "Other"]
+
+
+def test_notifier_should_deliver_in_background(tmp_path):
+    """
+    Check that notifying does not wait for sinks, and that pending notifications are delivered on close
+    """
+    released = threading.Event()
+
+    class SlowSink:
+        def send(self, event, message):
+            released.wait(5)
+
+    filename = tmp_path / 'notifications.log'
+    notifier = Notifier([SlowSink(), FileSink(str(filename))])
+    notifier.notify('slot_held', 'Slot held')
+    notifier.notify('booked', 'Appointment booked')
+    assert not filename.exists()
+
+    released.set()
+    notifier.close()
+    lines = filename.read_text().splitlines()
+    assert [line.split('] ', 1)[1] for line in lines] == ['slot_held: Slot held', 'booked: Appointment booked']
+
+
+@responses.activate
+def test_book_slot_should_trust_second_slot_until_rejected(tmp_path):
+    """
+    Check that the second shot given with the first one is booked directly, and looked up again only when rejected
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path, trust_second_slot=True)
+    docto.BASEURL = "https://127.0.0.1"
+    docto.patient = {"id": "patient-id", "first_name": "Roger", "last_name": "Phillibert"}
+
+    with open(FIXTURES_FOLDER + '/availabilities.json') as json_file:
+        mock_availabilities = json.load(json_file)
+
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=200, body=json.dumps({"id": "appointment-id"}))
+    responses.add(responses.GET, "https://127.0.0.1/appointments/appointment-id/edit.json",
+                  status=200, body=json.dumps({"appointment": {"custom_fields": {}}}))
+
+    assert docto.book_slot(1234, 2746983, 234567, [], "pfizer", "2021-06-10T08:40:00.000+02:00", "2021-07-20T08:40:00.000+02:00",
+                           only_second=False, only_third=False, dry_run=True)
+    assert not [call for call in responses.calls if 'second_shot' in call.request.url]
+    assert json.loads(responses.calls[1].request.body)['second_slot'] == "2021-07-20T08:40:00.000+02:00"
+
+    responses.reset()
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=200, body=json.dumps({"id": "appointment-id"}))
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=200, body=json.dumps({"error": "Second slot not available anymore"}))
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=200, body=json.dumps({"id": "appointment-id"}))
+    responses.add(responses.GET, "https://127.0.0.1/second_shot_availabilities.json",
+                  status=200, body=json.dumps(mock_availabilities))
+    responses.add(responses.GET, "https://127.0.0.1/appointments/appointment-id/edit.json",
+                  status=200, body=json.dumps({"appointment": {"custom_fields": {}}}))
+
+    assert docto.book_slot(1234, 2746983, 234567, [], "pfizer", "2021-06-10T08:40:00.000+02:00", "2021-07-20T09:00:00.000+02:00",
+                           only_second=False, only_third=False, dry_run=True)
+    second_slots = [json.loads(call.request.body).get('second_slot')
+                    for call in responses.calls if call.request.method == 'POST']
+    assert second_slots == [None, "2021-07-20T09:00:00.000+02:00", "2021-06-10T08:40:00.000+02:00"]
+
+
+@responses.activate
+def test_book_slot_should_keep_dose_gap_of_second_shot(tmp_path):
+    """
+    Check that second shot slots looked up after the first one are filtered by the dose gap
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path, dose_gap=(35, 45))
+    docto.BASEURL = "https://127.0.0.1"
+    docto.patient = {"id": "patient-id", "first_name": "Roger", "last_name": "Phillibert"}
+
+    second_shots = {"availabilities": [{"date": date, "slots": ["%sT08:40:00.000+02:00" % date]}
+                                       for date in ("2021-07-10", "2021-07-20", "2021-07-30")]}
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=200, body=json.dumps({"id": "appointment-id"}))
+    responses.add(responses.GET, "https://127.0.0.1/second_shot_availabilities.json",
+                  status=200, body=json.dumps(second_shots))
+    responses.add(responses.GET, "https://127.0.0.1/appointments/appointment-id/edit.json",
+                  status=200, body=json.dumps({"appointment": {"custom_fields": {}}}))
+
+    assert docto.book_slot(1234, 2746983, 234567, [], "pfizer", "2021-06-10T08:40:00.000+02:00", "2021-07-10T08:40:00.000+02:00",
+                           only_second=False, only_third=False, dry_run=True)
+    second_slots = [json.loads(call.request.body).get('second_slot')
+                    for call in responses.calls if call.request.method == 'POST']
+    assert second_slots == [None, "2021-07-20T08:40:00.000+02:00"]
+
+    docto.dose_gap = (None, 20)
+    assert not docto.book_slot(1234, 2746983, 234567, [], "pfizer", "2021-06-10T08:40:00.000+02:00", "2021-07-10T08:40:00.000+02:00",
+                               only_second=False, only_third=False, dry_run=True)
+
+
+@responses.activate
+def test_book_slot_should_learn_custom_field_answers(tmp_path, monkeypatch):
+    """
+    Check that answers to custom fields are asked once by patient, then reused from the store
+    """
+    filename = str(tmp_path / 'custom_fields.json')
+    answers = CustomFieldAnswers(filename)
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path, custom_field_answers=answers)
+    docto.BASEURL = "https://127.0.0.1"
+    docto.patient = {"id": "patient-id", "first_name": "Roger", "last_name": "Phillibert"}
+
+    custom_fields = [{"id": "insurance", "label": "Insurance", "required": True, "placeholder": None, "options": [["a", "AOK"], ["b", "TK"]]}]
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=200, body=json.dumps({"id": "appointment-id"}))
+    responses.add(responses.GET, "https://127.0.0.1/appointments/appointment-id/edit.json",
+                  status=200, body=json.dumps({"appointment": {"custom_fields": custom_fields}}))
+
+    readline = iter(["b\n", "a\n"]).__next__
+    monkeypatch.setattr('sys.stdin.readline', readline)
+    for _ in range(2):
+        assert docto.book_slot(1234, 2920448, 234567, [], "janssen", "2021-06-10T08:40:00.000+02:00", None,
+                               only_second=False, only_third=False, dry_run=True)
+    # another patient is asked again
+    docto.patient = {"id": 42, "first_name": "Lisa", "last_name": "Phillibert"}
+    assert docto.book_slot(1234, 2920448, 234567, [], "janssen", "2021-06-10T08:40:00.000+02:00", None,
+                           only_second=False, only_third=False, dry_run=True)
+    answers.save()
+
+    stored = CustomFieldAnswers(filename)
+    stored.load()
+    assert stored.get("patient-id", {"id": "insurance"}) == "b"
+    assert stored.get("patient-id", {"id": "other-id", "label": "Insurance"}) == "b"
+    assert stored.get(42, {"id": "insurance"}) == "a"
+    assert stored.get("other-patient", {"id": "insurance"}) is None
+
+
+@responses.activate
+def test_book_slot_should_answer_custom_fields_of_patient(tmp_path):
+    """
+    Check that both appointment edit requests are sent in order, and that custom fields come from the patient one
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path)
+    docto.BASEURL = "https://127.0.0.1"
+    docto.patient = {"id": "patient-id", "first_name": "Roger", "last_name": "Phillibert"}
+
+    def custom_fields(placeholder):
+        return json.dumps({"appointment": {"custom_fields": [
+            {"id": "insurance", "label": "Insurance", "required": True, "placeholder": placeholder}]}})
+
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=200, body=json.dumps({"id": "appointment-id"}))
+    responses.add(responses.GET, "https://127.0.0.1/appointments/appointment-id/edit.json",
+                  match=[matchers.query_param_matcher({})], status=200, body=custom_fields("any"))
+    responses.add(responses.GET, "https://127.0.0.1/appointments/appointment-id/edit.json",
+                  match=[matchers.query_param_matcher({"master_patient_id": "patient-id"})],
+                  status=200, body=custom_fields("patient"))
+    responses.add(responses.PUT, "https://127.0.0.1/appointments/appointment-id.json",
+                  status=200, body=json.dumps({"id": "appointment-id"}))
+    responses.add(responses.GET, "https://127.0.0.1/appointments/appointment-id.json",
+                  status=200, body=json.dumps({"confirmed": True}))
+
+    assert docto.book_slot(1234, 2920448, 234567, [], "janssen", "2021-06-10T08:40:00.000+02:00", None,
+                           only_second=False, only_third=False)
+
+    edits = [call.request.url for call in responses.calls if 'edit' in call.request.url]
+    assert edits == ["https://127.0.0.1/appointments/appointment-id/edit.json",
+                     "https://127.0.0.1/appointments/appointment-id/edit.json?master_patient_id=patient-id"]
+    put = [call for call in responses.calls if call.request.method == 'PUT'][0]
+    assert json.loads(put.request.body)['appointment']['custom_fields_values'] == {"insurance": "patient"}
+
+
+@responses.activate
+def test_try_to_book_place_should_release_other_held_slots(tmp_path):
+    """
+    Check that with speculative holds, the first slot held is booked and the other ones are released
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path, speculative_holds=2)
+    docto.BASEURL = "https://127.0.0.1"
+    docto.patient = {"id": "patient-id", "first_name": "Roger", "last_name": "Phillibert"}
+
+    with open(FIXTURES_FOLDER + '/availabilities.json') as json_file:
+        mock_availabilities = json.load(json_file)
+    responses.add(responses.GET, "https://127.0.0.1/availabilities.json",
+                  status=200, body=json.dumps(mock_availabilities))
+
+    for appointment_id in ("appointment-1", "appointment-2"):
+        responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                      status=200, body=json.dumps({"id": appointment_id}))
+        responses.add(responses.GET, "https://127.0.0.1/appointments/%s/edit.json" % appointment_id,
+                      status=200, body=json.dumps({"appointment": {"custom_fields": {}}}))
+        responses.add(responses.DELETE, "https://127.0.0.1/appointments/%s.json" % appointment_id,
+                      status=200, body=json.dumps({}))
+
+    assert docto.try_to_book_place(1234, 2920448, 234567, [], "janssen",
+                                   datetime.date(2021, 6, 1), datetime.date(2021, 6, 14), [],
+                                   only_second=False, only_third=False, dry_run=True)
+
+    edited = {call.request.url.split('/')[-2] for call in responses.calls if 'edit' in call.request.url}
+    released = [call.request.url.split('/')[-1][:-len('.json')] for call in responses.calls if call.request.method == 'DELETE']
+    assert len(edited) == 1
+    assert len(released) == 1
+    assert edited | set(released) == {"appointment-1", "appointment-2"}
+
+
+@responses.activate
+def test_book_speculatively_should_not_wait_for_lookups(tmp_path):
+    """
+    Check that slots are held while all workers of the session are busy looking up availabilities
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path, max_workers=1, speculative_holds=2)
+    docto.BASEURL = "https://127.0.0.1"
+    docto.patient = {"id": "patient-id", "first_name": "Roger", "last_name": "Phillibert"}
+
+    for appointment_id in ("appointment-1", "appointment-2"):
+        responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                      status=200, body=json.dumps({"id": appointment_id}))
+        responses.add(responses.GET, "https://127.0.0.1/appointments/%s/edit.json" % appointment_id,
+                      status=200, body=json.dumps({"appointment": {"custom_fields": {}}}))
+        responses.add(responses.DELETE, "https://127.0.0.1/appointments/%s.json" % appointment_id,
+                      status=200, body=json.dumps({}))
+
+    candidates = [{'profile_id': 1234, 'motive_id': 2920448, 'practice_id': 234567, 'agenda_ids': [], 'vac_name': 'Janssen',
+                   'slot': Slot(first)} for first in ("2021-06-10T08:30:00.000+02:00", "2021-06-10T08:40:00.000+02:00")]
+
+    lookup = threading.Event()
+    docto.session.executor.submit(lookup.wait, 10)
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            booking = executor.submit(docto.book_speculatively, candidates, False, False, dry_run=True)
+            assert booking.result(timeout=5)
+    finally:
+        lookup.set()
+
+
+@responses.activate
+def test_try_to_book_place_should_book_despite_failed_holds_and_releases(tmp_path):
+    """
+    Check that a hold failing with a server error is skipped, and that a failed release does not abort the booking
+    """
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path, speculative_holds=3)
+    docto.BASEURL = "https://127.0.0.1"
+    docto.patient = {"id": "patient-id", "first_name": "Roger", "last_name": "Phillibert"}
+
+    with open(FIXTURES_FOLDER + '/availabilities.json') as json_file:
+        mock_availabilities = json.load(json_file)
+    slots = mock_availabilities['availabilities'][0]['slots']
+    slots.append(dict(slots[0], start_date=slots[0]['start_date'].replace('08:30', '18:30')))
+    responses.add(responses.GET, "https://127.0.0.1/availabilities.json",
+                  status=200, body=json.dumps(mock_availabilities))
+
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=200, body=json.dumps({"id": "appointment-1"}))
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=500, body=json.dumps({}))
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=200, body=json.dumps({"id": "appointment-2"}))
+    for appointment_id in ("appointment-1", "appointment-2"):
+        responses.add(responses.GET, "https://127.0.0.1/appointments/%s/edit.json" % appointment_id,
+                      status=200, body=json.dumps({"appointment": {"custom_fields": {}}}))
+        responses.add(responses.DELETE, "https://127.0.0.1/appointments/%s.json" % appointment_id,
+                      status=503, body=json.dumps({}))
+
+    assert docto.try_to_book_place(1234, 2920448, 234567, [], "janssen",
+                                   datetime.date(2021, 6, 1), datetime.date(2021, 6, 14), [],
+                                   only_second=False, only_third=False, dry_run=True)
+
+    edited = {call.request.url.split('/')[-2] for call in responses.calls if 'edit' in call.request.url}
+    released = [call.request.url.split('/')[-1][:-len('.json')] for call in responses.calls if call.request.method == 'DELETE']
+    assert len(edited) == 1
+    assert len(released) == 1
+    assert edited | set(released) == {"appointment-1", "appointment-2"}
+
+
+@responses.activate
+def test_request_metrics_should_aggregate_by_endpoint(tmp_path):
+    """
+    Check that responses are measured by endpoint and exported as JSON and Prometheus text
+    """
+    metrics = RequestMetrics()
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path, metrics=metrics)
+    docto.BASEURL = "https://127.0.0.1"
+
+    responses.add(responses.GET, "https://127.0.0.1/availabilities.json",
+                  status=200, body='{"availabilities": []}')
+    responses.add(responses.GET, "https://127.0.0.1/booking/dr-dre.json",
+                  status=200, body='{}')
+
+    for _ in range(3):
+        docto.open("https://127.0.0.1/availabilities.json?start_date=2021-06-01")
+    docto.open("https://127.0.0.1/booking/dr-dre.json")
+
+    summary = metrics.summary()
+    assert sorted(summary.keys()) == ['availabilities', 'center_booking']
+    assert summary['availabilities']['count'] == 3
+    assert summary['availabilities']['bytes'] == 3 * len('{"availabilities": []}')
+    assert summary['availabilities']['statuses'] == {'200': 3}
+    assert summary['center_booking']['p99'] >= summary['center_booking']['p50'] >= 0
+
+    metrics.export(str(tmp_path / 'metrics.json'), str(tmp_path / 'metrics.prom'))
+    assert json.loads((tmp_path / 'metrics.json').read_text())['availabilities']['count'] == 3
+    assert 'doctoshotgun_responses_total{endpoint="availabilities",status="200"} 3' in (tmp_path / 'metrics.prom').read_text()
+
+
+def test_request_metrics_percentiles():
+    """
+    Check percentiles of latencies
+    """
+    metrics = RequestMetrics()
+    for latency in range(1, 101):
+        metrics.record('availabilities', latency / 100, 200, 0)
+
+    summary = metrics.summary()['availabilities']
+    assert (summary['p50'], summary['p95'], summary['p99']) == (0.5, 0.95, 0.99)
+
+
+@responses.activate
+def test_tracer_should_write_nested_spans(tmp_path):
+    """
+    Check that spans of a booking are written with their parents, and that a disabled tracer writes nothing
+    """
+    assert Tracer().span('round') is Tracer.NULL_SPAN
+
+    filename = tmp_path / 'trace.jsonl'
+    tracer = Tracer(str(filename))
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path, tracer=tracer)
+    docto.BASEURL = "https://127.0.0.1"
+    docto.patient = {"id": "patient-id", "first_name": "Roger", "last_name": "Phillibert"}
+
+    with open(FIXTURES_FOLDER + '/availabilities.json') as json_file:
+        mock_availabilities = json.load(json_file)
+    responses.add(responses.GET, "https://127.0.0.1/availabilities.json",
+                  status=200, body=json.dumps(mock_availabilities))
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=200, body=json.dumps({"id": "appointment-id"}))
+    responses.add(responses.GET, "https://127.0.0.1/appointments/appointment-id/edit.json",
+                  status=200, body=json.dumps({"appointment": {"custom_fields": {}}}))
+
+    with tracer.span('round', number=1):
+        assert docto.try_to_book_place(1234, 2920448, 234567, [], "janssen",
+                                       datetime.date(2021, 6, 1), datetime.date(2021, 6, 14), [],
+                                       only_second=False, only_third=False, dry_run=True)
+    tracer.close()
+
+    events = [json.loads(line) for line in filename.read_text().splitlines()]
+    spans = {event['name']: event for event in events}
+    assert spans['round']['args']['parent'] is None
+    assert spans['try_to_book_place']['args']['parent'] == spans['round']['args']['id']
+    assert spans['try_to_book_place']['args']['motive_id'] == 2920448
+    assert spans['find_availabilities']['args']['parent'] == spans['try_to_book_place']['args']['id']
+    assert spans['find_availabilities']['args']['windows'] == 5
+    assert spans['book_slot']['args']['parent'] == spans['try_to_book_place']['args']['id']
+    assert spans['POST appointment']['args']['parent'] == spans['book_slot']['args']['id']
+    assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in events)
+
+
+@responses.activate
+def test_tracer_should_nest_spans_of_background_lookups(tmp_path):
+    """
+    Check that centers probed and availabilities looked up by other threads are nested in the round
+    """
+    filename = tmp_path / 'trace.jsonl'
+    tracer = Tracer(str(filename))
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path, tracer=tracer)
+    docto.BASEURL = "https://127.0.0.1"
+
+    with open(FIXTURES_FOLDER + '/doctor_response.json') as json_file:
+        mock_doctor_response = json.load(json_file)
+    with open(FIXTURES_FOLDER + '/availabilities.json') as json_file:
+        mock_availabilities = json.load(json_file)
+    responses.add(responses.GET, "https://127.0.0.1/allgemeinmedizin/koeln/dr-dre",
+                  status=200, body=json.dumps(mock_doctor_response))
+    responses.add(responses.GET, "https://127.0.0.1/booking/dr-dre.json",
+                  status=200, body=json.dumps(mock_doctor_response))
+    responses.add(responses.GET, "https://127.0.0.1/availabilities.json",
+                  status=200, body=json.dumps(mock_availabilities))
+
+    center = {"url": "/allgemeinmedizin/koeln/dr-dre"}
+    with tracer.span('round', number=1), ThreadPoolExecutor(max_workers=1) as executor:
+        probe = executor.submit(tracer.bind(docto.probe_center), center, ["Janssen"], datetime.date(2021, 6, 1),
+                                datetime.date(2021, 6, 14), False, False).result()
+        for future in probe.availabilities.values():
+            future.result()
+    tracer.close()
+
+    events = [json.loads(line) for line in filename.read_text().splitlines()]
+    spans = {event['name']: event for event in events}
+    assert spans['probe_center']['args']['parent'] == spans['round']['args']['id']
+    assert spans['probe_center']['args']['center_id'] == 'dr-dre'
+    assert spans['find_availabilities']['args']['parent'] == spans['probe_center']['args']['id']
+    assert [event['args']['parent'] for event in events if event['name'] == 'GET center_booking'] == \
+        [spans['probe_center']['args']['id']]
+
+
+@responses.activate
+def test_booking_latency_should_record_every_attempt(tmp_path):
+    """
+    Check that every booking attempt is measured from the time its slot was received, step by step
+    """
+    booking_latency = BookingLatency()
+    docto = DoctolibDE("roger.phillibert@gmail.com",
+                       "1234", responses_dirname=tmp_path, booking_latency=booking_latency)
+    docto.BASEURL = "https://127.0.0.1"
+    docto.patient = {"id": "patient-id", "first_name": "Roger", "last_name": "Phillibert"}
+
+    with open(FIXTURES_FOLDER + '/availabilities.json') as json_file:
+        mock_availabilities = json.load(json_file)
+    responses.add(responses.GET, "https://127.0.0.1/availabilities.json",
+                  status=200, body=json.dumps(mock_availabilities))
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=200, body=json.dumps({"error": "Appointment not available anymore"}))
+    responses.add(responses.POST, "https://127.0.0.1/appointments.json",
+                  status=200, body=json.dumps({"id": "appointment-id"}))
+    responses.add(responses.GET, "https://127.0.0.1/appointments/appointment-id/edit.json",
+                  status=200, body=json.dumps({"appointment": {"custom_fields": {}}}))
+
+    assert docto.try_to_book_place(1234, 2920448, 234567, [], "janssen",
+                                   datetime.date(2021, 6, 1), datetime.date(2021, 6, 14), [],
+                                   only_second=False, only_third=False, dry_run=True)
+
+    summary = booking_latency.summary()
+    assert summary['attempts'] == 2
+    assert summary['outcomes'] == {'unavailable': 1, 'fake': 1}
+    assert sorted(summary['steps']) == ['appointment', 'appointment_edit']
+    # both attempts started when availabilities were received
+    assert summary['total']['p99'] >= summary['steps']['appointment']['p99'] + summary['steps']['appointment_edit']['p50']
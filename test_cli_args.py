@@ -79,6 +79,8 @@ def get_mocked_doctolib(MockDoctolibDE):
 
     mock_doctolib_de.find_centers.return_value = CENTERS
 
+    mock_doctolib_de.probe_center.return_value = None
+
     mock_doctolib_de.try_to_book.return_value = True
 
     mock_doctolib_de.load_state.return_value = None
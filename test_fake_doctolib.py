@@ -0,0 +1,55 @@
+import datetime
+import threading
+
+import pytest
+
+from doctoshotgun import DoctolibDE, DoctolibFR
+from fake_doctolib import FakeDoctolib, make_server
+
+
+@pytest.fixture
+def fake_doctolib():
+    doctolib = FakeDoctolib(seed=42, pages=3, centers_per_page=4, density=1.0, today=datetime.date(2021, 6, 1))
+    server = make_server(doctolib, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield doctolib, 'http://%s:%s' % server.server_address[:2]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('browser', [DoctolibDE, DoctolibFR])
+def test_find_centers_should_walk_all_pages(fake_doctolib, tmp_path, browser):
+    """
+    Check that all search pages of the fake server are found, with both pagination formats
+    """
+    doctolib, base_url = fake_doctolib
+    docto = browser("roger.phillibert@gmail.com", "1234", responses_dirname=tmp_path)
+    docto.BASEURL = base_url
+
+    assert docto.do_login(None)
+    centers = list(docto.find_centers(['koeln']))
+    assert len(centers) == 12
+    assert len(set(center['url'] for center in centers)) == 12
+
+
+def test_try_to_book_should_book_on_fake_server(fake_doctolib, tmp_path):
+    """
+    Check a whole booking on the fake server, and that the booked slot is not available anymore
+    """
+    doctolib, base_url = fake_doctolib
+    docto = DoctolibDE("roger.phillibert@gmail.com", "1234", responses_dirname=tmp_path)
+    docto.BASEURL = base_url
+
+    assert docto.do_login(None)
+    docto.patient = docto.get_patients()[0]
+    center = next(docto.find_centers(['koeln']))
+
+    assert docto.try_to_book(center, ['Pfizer'], datetime.date(2021, 6, 1), datetime.date(2021, 6, 7), [],
+                             only_second=False, only_third=False)
+
+    appointments = list(doctolib.appointments.values())
+    assert len(appointments) == 1
+    assert appointments[0]['confirmed']
+    assert 'second_slot' in appointments[0]
+    assert (appointments[0]['practice_id'], appointments[0]['slot']) in doctolib.taken
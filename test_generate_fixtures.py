@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from benchmark import make_page
+from doctoshotgun import AvailabilitiesPage, CenterBookingPage, CentersPage, Slot
+from generate_fixtures import availabilities_windows, booking_profile, centers_pages, main
+
+
+@pytest.mark.parametrize('country', ['fr', 'de'])
+def test_centers_pages_should_link_to_next_page(country):
+    """
+    Check that generated pages are parsed, and that their next links are found with both formats
+    """
+    pages = [make_page(CentersPage, html, 'text/html') for html in centers_pages(seed=3, pages=3, centers_per_page=50,
+                                                                                 country=country)]
+
+    assert [len(list(page.iter_centers_ids())) for page in pages] == [50, 50, 50]
+    assert [page.get_next_page() for page in pages] == [2, 3, None]
+
+
+def test_booking_profile_should_be_parsed():
+    """
+    Check the size of a generated booking profile, and that its agendas are found
+    """
+    doc = booking_profile(seed=1, motives=500, agendas=300, places=40)
+    page = make_page(CenterBookingPage, json.dumps(doc))
+
+    assert len(page.get_motives()) == 500
+    assert len(page.get_places()) == 40
+    agenda = doc['data']['agendas'][0]
+    assert page.get_agenda_ids(agenda['visit_motive_ids'][0])
+
+
+def test_availabilities_windows_should_use_all_slot_formats():
+    """
+    Check that slots of the three formats are generated and parsed, with the second shot when there is one
+    """
+    windows = availabilities_windows(seed=2, windows=30, density=0.5)
+    slots = [slot for doc in windows for day in doc['availabilities'] for slot in day['slots']]
+
+    assert set(type(slot) for slot in slots) == {dict, str, list}
+    assert all(Slot.from_doc(slot) for slot in slots)
+    assert all(Slot.from_doc(slot).second for slot in slots if not isinstance(slot, str))
+
+    for i, doc in enumerate(windows):
+        if doc.get('next_slot'):
+            assert not doc['total']
+            assert any(day['date'] == doc['next_slot'] and day['slots']
+                       for later in windows[i + 1:] for day in later['availabilities'])
+
+    page = make_page(AvailabilitiesPage, json.dumps(windows[0]))
+    assert sum(len(day['slots']) for day in windows[0]['availabilities']) == windows[0]['total']
+    assert len(list(page.get_days())) == 3
+
+
+def test_generated_fixtures_should_be_deterministic(tmp_path):
+    """
+    Check that the same seed writes the same fixtures, and that another seed does not
+    """
+    for folder, seed in (('a', '7'), ('b', '7'), ('c', '8')):
+        assert main([str(tmp_path / folder), '--seed', seed, '--pages', '2', '--windows', '4',
+                     '--motives', '20', '--agendas', '10', '--places', '3']) == 0
+
+    files = sorted(path.name for path in (tmp_path / 'a').iterdir())
+    assert files == ['availabilities_1.json', 'availabilities_2.json', 'availabilities_3.json', 'availabilities_4.json',
+                     'booking.json', 'centers_page_1.html', 'centers_page_2.html']
+    assert all((tmp_path / 'a' / name).read_text() == (tmp_path / 'b' / name).read_text() for name in files)
+    assert (tmp_path / 'a' / 'booking.json').read_text() != (tmp_path / 'c' / 'booking.json').read_text()